@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Replays scripted classroom scenarios against QueueBot on the fake
+# gateway, and reports events per second, REST calls per event and the
+# latency of queued events.
+#
+#     python3 bench/bench_events.py --students 300
+#     python3 bench/bench_events.py --latency 0.05 --bucket-interval 0.25
+
+import os
+import sys
+import argparse
+import asyncio
+import time
+import json
+import functools
+import logging
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import queue_bot
+from fake_discord import World, FakeGateway, RateLimits
+
+class Classroom:
+
+    def __init__(self, world, *, students, teachers, rooms):
+        self.world = world
+        self.guild = guild = world.add_guild("Курс")
+        teacher_role = world.add_role(guild, "Преподаватель")
+        self.text = world.add_channel(guild, "очередь")
+        world.add_channel(guild, "болталка")
+        self.queue_voice = world.add_channel(guild, "Очередь", voice=True)
+        self.rooms = [ world.add_channel(guild, f"Комната {i}", voice=True)
+            for i in range(rooms) ]
+        self.teachers = [
+            world.add_member(guild, f"teacher{i}", roles=[teacher_role])
+            for i in range(teachers) ]
+        for i, teacher in enumerate(self.teachers):
+            guild.members[teacher].voice = self.rooms[i % rooms]
+        self.students = [ world.add_member(guild, f"student{i}")
+            for i in range(students) ]
+        self.messages = dict()
+
+class Probe:
+    # times every queued event from its dispatch until its job is done,
+    # and every call of the methods that do the actual work
+
+    METHODS = ("consider_message", "update_student")
+
+    def __init__(self, client):
+        self.latencies = defaultdict(list)
+        inbox = client.inbox
+        submit, put = inbox.submit, inbox.put
+        def timed_submit(guild_id, kind, action, **kwargs):
+            # an event that waits for room is timed from the first try
+            return submit(guild_id, kind, self.timed_job(action), **kwargs)
+        def timed_put(guild_id, kind, action, **kwargs):
+            if not getattr(action, "timed", False):
+                action = self.timed_job(action)
+            return put(guild_id, kind, action, **kwargs)
+        inbox.submit, inbox.put = timed_submit, timed_put
+        for name in self.METHODS:
+            setattr(client, name, self.timed(name, getattr(client, name)))
+
+    def timed_job(self, action):
+        start = time.perf_counter()
+        async def timed_action():
+            try:
+                return await action()
+            finally:
+                self.latencies["handlers"].append(time.perf_counter() - start)
+        # keep the handler name for the metrics of the bot
+        functools.update_wrapper( timed_action,
+            getattr(action, "func", action), updated=() )
+        timed_action.timed = True
+        return timed_action
+
+    def timed(self, name, method):
+        async def timed_method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.latencies[name].append(time.perf_counter() - start)
+        return timed_method
+
+    def reset(self):
+        self.latencies.clear()
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.world = World()
+        self.classroom = Classroom( self.world,
+            students=args.students, teachers=args.teachers,
+            rooms=max(args.teachers, 2) )
+        self.limits = RateLimits( latency=args.latency,
+            bucket_interval=args.bucket_interval,
+            global_interval=args.global_interval )
+        self.results = dict()
+
+    def start_bot(self):
+        bot = queue_bot.QueueBot(**self.bot_kwargs())
+        gateway = FakeGateway(bot, self.world, limits=self.limits)
+        return bot, gateway, Probe(bot)
+
+    def bot_kwargs(self):
+        return dict( coalesce_window=self.args.coalesce_window,
+            reconcile_concurrency=self.args.reconcile_concurrency,
+            lean_members=self.args.lean_members,
+            event_workers=self.args.event_workers,
+            event_queue_size=self.args.event_queue_size,
+            event_overflow=self.args.event_overflow )
+
+    async def measure(self, name, gateway, probe, scenario):
+        events_before = sum(gateway.events.values())
+        calls_before = gateway.http.calls.copy()
+        hits_before = self.limits.hits
+        probe.reset()
+        start = time.perf_counter()
+        await scenario()
+        await gateway.settle()
+        duration = time.perf_counter() - start
+        events = sum(gateway.events.values()) - events_before
+        calls = gateway.http.calls - calls_before
+        self.results[name] = result = {
+            "events": events,
+            "seconds": round(duration, 3),
+            "events_per_second": round(events / duration, 1)
+                if events else None,
+            "rest_calls": sum(calls.values()),
+            "rest_calls_per_event": round(sum(calls.values()) / events, 3)
+                if events else None,
+            "rest_calls_by_kind": dict(sorted(calls.items())),
+            "rate_limit_hits": self.limits.hits - hits_before,
+        }
+        for name in ("handlers",) + Probe.METHODS:
+            latencies = sorted(probe.latencies.get(name, ()))
+            result[name] = len(latencies)
+            result[f"{name}_p50_ms"] = percentile_ms(latencies, 0.50)
+            result[f"{name}_p99_ms"] = percentile_ms(latencies, 0.99)
+        return result
+
+    async def run(self):
+        classroom = self.classroom
+        guild = classroom.guild
+        bot, gateway, probe = self.start_bot()
+        await self.measure("connect", gateway, probe, gateway.connect)
+
+        async def arrival():
+            # every student signs up and joins the queue, some of them
+            # only after a while
+            for i, student in enumerate(classroom.students):
+                classroom.messages[student] = gateway.post(
+                    student, classroom.text )
+                if i % 4 != 3:
+                    gateway.move(guild, student, classroom.queue_voice)
+                await asyncio.sleep(0)
+            for i, student in enumerate(classroom.students):
+                if i % 4 == 3:
+                    gateway.move(guild, student, classroom.queue_voice)
+            await gateway.settle()
+        await self.measure("arrival", gateway, probe, arrival)
+
+        async def flapping():
+            # students hop around voice channels
+            hoppers = classroom.students[:self.args.hoppers]
+            for hop in range(self.args.hops):
+                for student in hoppers:
+                    room = classroom.rooms[hop % len(classroom.rooms)]
+                    gateway.move( guild, student,
+                        room if hop % 2 == 0 else classroom.queue_voice )
+                await asyncio.sleep(0.01)
+            for student in hoppers:
+                gateway.move(guild, student, classroom.queue_voice)
+        await self.measure("flapping", gateway, probe, flapping)
+
+        async def lesson():
+            # teachers call the next student; talked-to students leave
+            # and delete their message
+            for _ in range(self.args.rounds):
+                for teacher in classroom.teachers:
+                    gateway.post( teacher, classroom.text, "следующий",
+                        mention_bot=True )
+                await gateway.settle()
+                for student in classroom.students:
+                    voice = guild.members[student].voice
+                    if voice in classroom.rooms:
+                        gateway.move(guild, student, None)
+                        message = classroom.messages.pop(student, None)
+                        if message is not None:
+                            gateway.delete(message)
+        await self.measure("lesson", gateway, probe, lesson)
+
+        await bot.close()
+        bot, gateway, probe = self.start_bot()
+        await self.measure("restart", gateway, probe, gateway.connect)
+        await bot.close()
+        return self.results
+
+def percentile_ms(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return round(values[index] * 1000, 2)
+
+def print_results(results):
+    for name, result in results.items():
+        print(f"{name}:")
+        for key, value in result.items():
+            print(f"    {key}: {value}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Event throughput benchmark for QueueBot" )
+    parser.add_argument("--students", type=int, default=300)
+    parser.add_argument("--teachers", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=10,
+        help="how many times every teacher calls the next student" )
+    parser.add_argument("--hoppers", type=int, default=50,
+        help="students hopping between voice channels" )
+    parser.add_argument("--hops", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="seconds every REST call takes" )
+    parser.add_argument("--bucket-interval", type=float, default=0.0,
+        help="seconds between REST calls in one rate-limit bucket" )
+    parser.add_argument("--global-interval", type=float, default=0.0,
+        help="seconds between any REST calls" )
+    parser.add_argument("--coalesce-window", type=float,
+        default=queue_bot.COALESCE_WINDOW )
+    parser.add_argument("--reconcile-concurrency", type=int,
+        default=queue_bot.RECONCILE_CONCURRENCY )
+    parser.add_argument("--lean-members", action="store_true",
+        help="cache only members in voice channels" )
+    parser.add_argument("--event-workers", type=int,
+        default=queue_bot.EVENT_WORKERS )
+    parser.add_argument("--event-queue-size", type=int,
+        default=queue_bot.EVENT_QUEUE_SIZE )
+    parser.add_argument("--event-overflow", choices=["shed", "wait"],
+        default="shed" )
+    parser.add_argument("--json", action="store_true",
+        help="print the results as JSON" )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(Bench(args).run())
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_results(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Measures how much memory QueueBot keeps per tracked student: queue
+# states, the queue index and expiry deadlines, with tracemalloc.
+# Students are measured after their events are done, when they keep
+# no mailbox or task.
+#
+#     python3 bench/bench_memory.py
+#     python3 bench/bench_memory.py --students 10000,100000,1000000
+
+import os
+import sys
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord
+
+import queue_bot
+from bench_events import print_results
+
+def traced():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+async def measure(args, students):
+    random.seed(students)
+    snowflake = discord.utils.time_snowflake(discord.utils.utcnow())
+    guild_ids = [snowflake + i for i in range(args.guilds)]
+    channel_ids = [snowflake + args.guilds + i for i in range(args.channels)]
+    bot = queue_bot.QueueBot()
+    start = traced()
+    states = list()
+    for i in range(students):
+        guild_id = guild_ids[i % len(guild_ids)]
+        state = bot.add_queue_state(guild_id, snowflake + (i << 12))
+        # most students post in one channel, some in two
+        for channel_id in random.sample( channel_ids,
+                2 if random.random() < args.second_channel else 1 ):
+            state.put( channel_id, snowflake + (i << 12) + channel_id % 4096,
+                random.random() < args.finished )
+        states.append(state)
+    after_states = traced()
+    for state in states:
+        bot.queue_state_updated(state, touch=False)
+    after_index = traced()
+    # every student handles an event once
+    async def handle(state):
+        pass
+    for state in states:
+        await bot.ask_student(state, handle)
+    after_events = traced()
+    result = {
+        "students": students,
+        "bytes_per_student": round((after_events - start) / students, 1),
+        "queue_states_bytes_per_student":
+            round((after_states - start) / students, 1),
+        "queue_index_bytes_per_student":
+            round((after_index - after_states) / students, 1),
+        "events_bytes_per_student":
+            round((after_events - after_index) / students, 1),
+        "busy_students": len(bot.busy_students),
+        "total_mib": round((after_events - start) / (1 << 20), 2),
+    }
+    del states
+    await bot.close()
+    return result
+
+async def run(args):
+    results = dict()
+    for students in args.students:
+        results[f"{students} students"] = await measure(args, students)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Memory benchmark of queue states for QueueBot" )
+    parser.add_argument("--students",
+        type=lambda value: [int(part) for part in value.split(",")],
+        default=[10000, 100000],
+        help="comma-separated numbers of tracked students" )
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=3,
+        help="queue channels of every server" )
+    parser.add_argument("--second-channel", type=float, default=0.1,
+        help="share of students with messages in two channels" )
+    parser.add_argument("--finished", type=float, default=0.2,
+        help="share of messages that are finished" )
+    parser.add_argument("--json", action="store_true",
+        help="print the results as JSON" )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    tracemalloc.start()
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_results(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,609 @@
+# A stand-in for the part of Discord that QueueBot talks to.
+#
+# World holds guilds, channels, members and messages.  FakeGateway feeds
+# gateway events for it into a real discord.Client (through the client's
+# connection state, as the websocket would), and replaces the client's
+# HTTP client with FakeHTTP, which answers REST calls from the world and
+# echoes them back as gateway events.  RateLimits adds latency and
+# per-bucket and global rate limits to the REST calls.
+
+import asyncio
+import time
+import json
+import itertools
+from collections import Counter
+from datetime import timedelta
+
+import discord
+
+# messages of a fresh world are as old as this
+EPOCH_OFFSET = timedelta(days=1)
+# as Discord: larger guilds come without most of their members
+LARGE_THRESHOLD = 250
+MEMBER_CHUNK_SIZE = 1000
+
+class World:
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.guilds = dict()
+        self.users = dict()
+        self.messages = dict()
+        self.bot_id = self.snowflake()
+        self.users[self.bot_id] = self.user_payload(self.bot_id, "QueueBot")
+
+    def snowflake(self, created_at=None):
+        if created_at is None:
+            created_at = discord.utils.utcnow() - EPOCH_OFFSET
+        return discord.utils.time_snowflake(created_at) + next(self.ids)
+
+    def user_payload(self, user_id, name):
+        return { "id": str(user_id), "username": name,
+            "discriminator": "0", "global_name": name, "avatar": None,
+            "bot": user_id == getattr(self, "bot_id", user_id) }
+
+    def add_guild(self, name, *, shard=None):
+        guild_id = self.snowflake()
+        if shard is not None:
+            # (shard_id, shard_count): a few milliseconds later, so that
+            # the guild is on that shard
+            shard_id, shard_count = shard
+            guild_id += ((shard_id - (guild_id >> 22)) % shard_count) << 22
+        self.guilds[guild_id] = guild = FakeGuild(guild_id, name)
+        guild.members[self.bot_id] = FakeMember(self.bot_id, ())
+        return guild
+
+    def add_role(self, guild, name):
+        role_id = self.snowflake()
+        guild.roles[role_id] = name
+        return role_id
+
+    def add_channel(self, guild, name, *, voice=False, category=None,
+        is_category=False,
+    ):
+        channel_id = self.snowflake()
+        guild.channels[channel_id] = FakeChannel( channel_id, name,
+            type=4 if is_category else 2 if voice else 0,
+            position=len(guild.channels),
+            parent_id=category )
+        return channel_id
+
+    def add_member(self, guild, name, *, roles=()):
+        user_id = self.snowflake()
+        self.users[user_id] = self.user_payload(user_id, name)
+        guild.members[user_id] = FakeMember(user_id, tuple(roles))
+        return user_id
+
+    def guild_of_channel(self, channel_id):
+        for guild in self.guilds.values():
+            if channel_id in guild.channels:
+                return guild
+        raise KeyError(channel_id)
+
+    def member_payload(self, guild, user_id):
+        member = guild.members[user_id]
+        return { "user": self.users[user_id],
+            "roles": [str(role) for role in member.roles],
+            "joined_at": "2020-01-01T00:00:00+00:00",
+            "deaf": False, "mute": False, "flags": 0 }
+
+    def voice_payload(self, guild, user_id):
+        member = guild.members[user_id]
+        return { "guild_id": str(guild.id), "user_id": str(user_id),
+            "channel_id": None if member.voice is None else str(member.voice),
+            "session_id": "session", "deaf": False, "mute": False,
+            "self_deaf": False, "self_mute": True, "self_video": False,
+            "suppress": False, "request_to_speak_timestamp": None,
+            "member": self.member_payload(guild, user_id) }
+
+    def guild_payload(self, guild):
+        large = len(guild.members) > LARGE_THRESHOLD
+        roles = [{ "id": str(guild.id), "name": "@everyone",
+            "position": 0, "permissions": "0", "color": 0, "hoist": False,
+            "managed": False, "mentionable": False }]
+        for position, (role_id, name) in enumerate(guild.roles.items(), 1):
+            roles.append({ "id": str(role_id), "name": name,
+                "position": position, "permissions": "0", "color": 0,
+                "hoist": False, "managed": False, "mentionable": False })
+        return { "id": str(guild.id), "name": guild.name,
+            "unavailable": False, "member_count": len(guild.members),
+            "large": large, "owner_id": str(self.bot_id),
+            "roles": roles, "emojis": [], "stickers": [], "features": [],
+            "channels": [ channel.payload(guild.id)
+                for channel in guild.channels.values() ],
+            "members": [ self.member_payload(guild, user_id)
+                for user_id, member in guild.members.items()
+                if not large or member.voice is not None
+                    or user_id == self.bot_id ],
+            "voice_states": [ self.voice_payload(guild, user_id)
+                for user_id, member in guild.members.items()
+                if member.voice is not None ],
+            "threads": [], "stage_instances": [],
+            "guild_scheduled_events": [], "presences": [],
+            "verification_level": 0, "default_message_notifications": 0,
+            "explicit_content_filter": 0, "mfa_level": 0, "nsfw_level": 0,
+            "premium_tier": 0, "preferred_locale": "ru",
+            "afk_timeout": 300, "system_channel_flags": 0 }
+
+    def message_payload(self, message, *, viewer=None):
+        guild = self.guild_of_channel(message.channel_id)
+        data = { "id": str(message.id), "channel_id": str(message.channel_id),
+            "guild_id": str(guild.id), "author": self.users[message.author_id],
+            "content": message.content, "type": 0, "tts": False,
+            "timestamp": discord.utils.snowflake_time(message.id).isoformat(),
+            "edited_timestamp": None, "mention_everyone": False,
+            "mentions": [ self.users[user_id]
+                for user_id in message.mentions ],
+            "mention_roles": [], "attachments": [], "embeds": [],
+            "pinned": False, "flags": 0,
+            "reactions": [ { "emoji": {"id": None, "name": emoji},
+                    "count": len(users), "me": self.bot_id in users,
+                    "count_details": {"normal": len(users), "burst": 0},
+                    "burst_colors": [], "me_burst": False,
+                    "burst_count": 0 }
+                for emoji, users in message.reactions.items() if users ] }
+        if message.author_id in guild.members:
+            data["member"] = self.member_payload(guild, message.author_id)
+            del data["member"]["user"]
+        return data
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id, name):
+        self.id = guild_id
+        self.name = name
+        self.roles = dict()
+        self.channels = dict()
+        self.members = dict()
+
+
+class FakeChannel:
+
+    def __init__(self, channel_id, name, *, type, position, parent_id):
+        self.id = channel_id
+        self.name = name
+        self.type = type
+        self.position = position
+        self.parent_id = parent_id
+        self.messages = list()
+
+    def payload(self, guild_id):
+        data = { "id": str(self.id), "name": self.name, "type": self.type,
+            "position": self.position, "guild_id": str(guild_id),
+            "permission_overwrites": [], "nsfw": False,
+            "parent_id": None if self.parent_id is None
+                else str(self.parent_id) }
+        if self.type == 2:
+            data.update(bitrate=64000, user_limit=0, rtc_region=None)
+        return data
+
+
+class FakeMember:
+
+    def __init__(self, user_id, roles):
+        self.id = user_id
+        self.roles = roles
+        self.voice = None
+
+
+class FakeMessage:
+
+    def __init__(self, message_id, channel_id, author_id, content, mentions):
+        self.id = message_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.content = content
+        self.mentions = mentions
+        self.reactions = dict()
+
+
+class RateLimits:
+    # Every call takes latency seconds; calls in the same bucket are
+    # bucket_interval seconds apart, and all calls global_interval apart.
+    # hits counts the calls that had to wait for a limit.
+
+    def __init__( self, *,
+        latency=0.0, bucket_interval=0.0, global_interval=0.0,
+    ):
+        self.latency = latency
+        self.bucket_interval = bucket_interval
+        self.global_interval = global_interval
+        self.buckets = dict()
+        self.hits = 0
+
+    async def wait(self, bucket):
+        if self.bucket_interval:
+            await self.wait_bucket(bucket, self.bucket_interval)
+        if self.global_interval:
+            await self.wait_bucket(None, self.global_interval)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def wait_bucket(self, bucket, interval):
+        limit = self.buckets.get(bucket)
+        if limit is None:
+            limit = self.buckets[bucket] = [asyncio.Lock(), 0.0]
+        async with limit[0]:
+            delay = limit[1] - time.monotonic()
+            if delay > 0:
+                self.hits += 1
+                await asyncio.sleep(delay)
+            limit[1] = time.monotonic() + interval
+
+
+class FakeHTTP:
+    # the methods of discord.http.HTTPClient that QueueBot ends up calling
+
+    def __init__(self, world, gateway, limits):
+        self.world = world
+        self.gateway = gateway
+        self.limits = limits
+        self.calls = Counter()
+        self.in_flight = 0
+        self.loop = None
+
+    async def call(self, kind, bucket):
+        self.calls[kind] += 1
+        self.in_flight += 1
+        try:
+            await self.limits.wait((kind,) + bucket)
+        finally:
+            self.in_flight -= 1
+
+    def message(self, channel_id, message_id):
+        try:
+            message = self.world.messages[message_id]
+        except KeyError:
+            raise discord.NotFound(FakeResponse(404), "Unknown Message")
+        if message.channel_id != int(channel_id):
+            raise discord.NotFound(FakeResponse(404), "Unknown Message")
+        return message
+
+    async def get_message(self, channel_id, message_id):
+        await self.call("get_message", (int(channel_id),))
+        return self.world.message_payload(
+            self.message(channel_id, int(message_id)) )
+
+    async def logs_from( self, channel_id, limit,
+        before=None, after=None, around=None,
+    ):
+        await self.call("logs_from", (int(channel_id),))
+        guild = self.world.guild_of_channel(int(channel_id))
+        messages = guild.channels[int(channel_id)].messages
+        if after is not None:
+            selected = [m for m in messages if m.id > int(after)][:limit]
+        else:
+            if before is not None:
+                selected = [m for m in messages if m.id < int(before)]
+            else:
+                selected = messages
+            selected = selected[-limit:]
+        return [ self.world.message_payload(message)
+            for message in reversed(selected) ]
+
+    async def get_reaction_users( self, channel_id, message_id, emoji,
+        limit, after=None, type=None,
+    ):
+        await self.call("get_reaction_users", (int(channel_id),))
+        message = self.message(channel_id, int(message_id))
+        users = sorted(message.reactions.get(emoji, ()))
+        if after is not None:
+            users = [user_id for user_id in users if user_id > int(after)]
+        return [self.world.users[user_id] for user_id in users[:limit]]
+
+    async def add_reaction(self, channel_id, message_id, emoji):
+        await self.call("add_reaction", (int(channel_id),))
+        message = self.message(channel_id, int(message_id))
+        users = message.reactions.setdefault(emoji, set())
+        if self.world.bot_id in users:
+            return
+        users.add(self.world.bot_id)
+        self.gateway.later( self.gateway.emit_reaction_add,
+            message, self.world.bot_id, emoji )
+
+    async def clear_single_reaction(self, channel_id, message_id, emoji):
+        await self.call("clear_single_reaction", (int(channel_id),))
+        message = self.message(channel_id, int(message_id))
+        if not message.reactions.pop(emoji, None):
+            return
+        self.gateway.later( self.gateway.emit_reaction_clear_emoji,
+            message, emoji )
+
+    async def edit_member(self, guild_id, user_id, *, reason=None, **fields):
+        await self.call("edit_member", (int(guild_id),))
+        guild = self.world.guilds[int(guild_id)]
+        if "channel_id" in fields:
+            channel_id = fields["channel_id"]
+            guild.members[int(user_id)].voice = \
+                None if channel_id is None else int(channel_id)
+            self.gateway.later( self.gateway.emit_voice,
+                guild, int(user_id) )
+        return self.world.member_payload(guild, int(user_id))
+
+    async def send_message(self, channel_id, *, params):
+        await self.call("send_message", (int(channel_id),))
+        message = self.gateway.create_message( int(channel_id),
+            self.world.bot_id, params.payload.get("content", "") )
+        self.gateway.later(self.gateway.emit_message, message)
+        return self.world.message_payload(message)
+
+    async def edit_message(self, channel_id, message_id, *, params):
+        await self.call("edit_message", (int(channel_id),))
+        message = self.message(channel_id, int(message_id))
+        message.content = params.payload.get("content", message.content)
+        return self.world.message_payload(message)
+
+    async def delete_message(self, channel_id, message_id, *, reason=None):
+        await self.call("delete_message", (int(channel_id),))
+        message = self.message(channel_id, int(message_id))
+        self.gateway.remove_message(message)
+        self.gateway.later(self.gateway.emit_message_delete, message)
+
+    async def get_member(self, guild_id, member_id):
+        await self.call("get_member", (int(guild_id),))
+        guild = self.world.guilds[int(guild_id)]
+        if int(member_id) not in guild.members:
+            raise discord.NotFound(FakeResponse(404), "Unknown Member")
+        return self.world.member_payload(guild, int(member_id))
+
+    async def close(self):
+        pass
+
+
+class FakeResponse:
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = "fake"
+
+
+class FakeWebSocket:
+    # member requests (as in chunking and Guild.query_members),
+    # answered with GUILD_MEMBERS_CHUNK events
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.requests = 0
+
+    async def request_chunks( self, guild_id, query=None, *,
+        limit, user_ids=None, presences=False, nonce=None,
+    ):
+        self.requests += 1
+        asyncio.get_running_loop().create_task( self.answer(
+                int(guild_id), query, limit, user_ids, nonce ),
+            name="discord.py: members chunk" )
+
+    async def answer(self, *args):
+        # not before discord.py is waiting for the answer
+        await asyncio.sleep(0.001)
+        self.gateway.emit_members_chunks(*args)
+
+class FakeGateway:
+
+    def __init__(self, client, world, *, limits=None):
+        self.client = client
+        self.world = world
+        self.state = client._connection
+        self.http = FakeHTTP(world, self, limits or RateLimits())
+        self.state.http = client.http = self.http
+        self.websocket = FakeWebSocket(self)
+        self.state._get_websocket = \
+            lambda guild_id=None, *, shard_id=None: self.websocket
+        self.events = Counter()
+        self.sequence = 0
+
+    async def connect(self):
+        await self.client._async_setup_hook()
+        self.http.loop = asyncio.get_running_loop()
+        await self.client.setup_hook()
+        # every shard of an AutoShardedClient gets its READY
+        shard_ids = getattr(self.client, "shard_ids", None) or (None,)
+        for shard_id in shard_ids:
+            ready = { "v": 10, "session_id": "fake",
+                "user": self.world.users[self.world.bot_id],
+                "guilds": [], "application": {
+                    "id": str(self.world.bot_id), "flags": 0 } }
+            if shard_id is not None:
+                ready["shard"] = [shard_id, self.client.shard_count]
+            self.feed("READY", ready)
+        if shard_ids != (None,):
+            for task in self.state._ready_tasks.values():
+                task.cancel()
+            self.state._ready_tasks.clear()
+            self.state._ready_states.clear()
+            if self.state._ready_task is not None:
+                self.state._ready_task.cancel()
+        else:
+            self.state._ready_task.cancel()
+            del self.state._ready_state
+        self.client._ready.set()
+        for guild in self.world.guilds.values():
+            self.feed("GUILD_CREATE", self.world.guild_payload(guild))
+        if shard_ids != (None,):
+            for shard_id in shard_ids:
+                self.client.dispatch("shard_ready", shard_id)
+        await self.settle()
+
+    def feed(self, event, data):
+        # as the websocket of discord.py would
+        if self.client._enable_debug_events:
+            self.sequence += 1
+            self.client.dispatch( "socket_raw_receive", json.dumps(
+                { "op": 0, "t": event, "s": self.sequence, "d": data },
+                ensure_ascii=False ) )
+        self.state.parsers[event](data)
+
+    def idle(self):
+        busy = [ task for task in asyncio.all_tasks()
+            if not task.done() and
+            task.get_name().startswith(("discord.py: ", "queue-bot: ")) ]
+        # updates that the bot has put off for a while
+        pending = getattr(self.client, "pending_updates", None)
+        return busy, not busy and not self.http.in_flight and not pending
+
+    async def settle(self, *, quiet=0.02):
+        # wait until event handlers are done and REST traffic has stopped
+        while True:
+            while True:
+                await asyncio.sleep(0)
+                busy, idle = self.idle()
+                if idle:
+                    break
+                if busy:
+                    await asyncio.wait(busy, timeout=quiet)
+                else:
+                    await asyncio.sleep(quiet)
+            total = sum(self.http.calls.values())
+            await asyncio.sleep(quiet)
+            if total == sum(self.http.calls.values()) and self.idle()[1]:
+                return
+
+    def later(self, function, *args):
+        asyncio.get_running_loop().call_soon(function, *args)
+
+    def create_message(self, channel_id, author_id, content, *, mentions=()):
+        guild = self.world.guild_of_channel(channel_id)
+        message = FakeMessage( self.world.snowflake(), channel_id,
+            author_id, content, tuple(mentions) )
+        guild.channels[channel_id].messages.append(message)
+        self.world.messages[message.id] = message
+        return message
+
+    def remove_message(self, message):
+        guild = self.world.guild_of_channel(message.channel_id)
+        guild.channels[message.channel_id].messages.remove(message)
+        del self.world.messages[message.id]
+
+    def emit_message(self, message):
+        self.events["message"] += 1
+        self.feed( "MESSAGE_CREATE",
+            self.world.message_payload(message) )
+
+    def emit_message_delete(self, message):
+        self.events["message_delete"] += 1
+        guild = self.world.guild_of_channel(message.channel_id)
+        self.feed( "MESSAGE_DELETE", { "id": str(message.id),
+            "channel_id": str(message.channel_id),
+            "guild_id": str(guild.id) })
+
+    def emit_message_delete_bulk(self, messages):
+        self.events["message_delete_bulk"] += 1
+        channel_id = messages[0].channel_id
+        guild = self.world.guild_of_channel(channel_id)
+        self.feed( "MESSAGE_DELETE_BULK", {
+            "ids": [str(message.id) for message in messages],
+            "channel_id": str(channel_id), "guild_id": str(guild.id) })
+
+    def emit_members_chunks(self, guild_id, query, limit, user_ids, nonce):
+        guild = self.world.guilds[guild_id]
+        if user_ids is not None:
+            found = [ user_id for user_id in map(int, user_ids)
+                if user_id in guild.members ]
+        else:
+            found = [ user_id for user_id in guild.members
+                if self.world.users[user_id]["username"].startswith(
+                    query or "" ) ]
+            if limit:
+                found = found[:limit]
+        chunks = [ found[start:start+MEMBER_CHUNK_SIZE]
+            for start in range(0, len(found), MEMBER_CHUNK_SIZE) ] or [[]]
+        for index, chunk in enumerate(chunks):
+            self.events["members_chunk"] += 1
+            data = { "guild_id": str(guild_id),
+                "members": [ self.world.member_payload(guild, user_id)
+                    for user_id in chunk ],
+                "chunk_index": index, "chunk_count": len(chunks),
+                "nonce": nonce }
+            if user_ids is not None and index == 0:
+                data["not_found"] = [ str(user_id) for user_id in user_ids
+                    if int(user_id) not in guild.members ]
+            self.feed("GUILD_MEMBERS_CHUNK", data)
+
+    def emit_voice(self, guild, user_id):
+        self.events["voice"] += 1
+        self.feed( "VOICE_STATE_UPDATE",
+            self.world.voice_payload(guild, user_id) )
+
+    def emit_reaction_add(self, message, user_id, emoji):
+        self.events["reaction_add"] += 1
+        guild = self.world.guild_of_channel(message.channel_id)
+        data = { "user_id": str(user_id),
+            "channel_id": str(message.channel_id),
+            "message_id": str(message.id), "guild_id": str(guild.id),
+            "message_author_id": str(message.author_id),
+            "emoji": {"id": None, "name": emoji},
+            "burst": False, "burst_colors": [], "type": 0 }
+        if user_id in guild.members:
+            data["member"] = self.world.member_payload(guild, user_id)
+        self.feed("MESSAGE_REACTION_ADD", data)
+
+    def emit_reaction_remove(self, message, user_id, emoji):
+        self.events["reaction_remove"] += 1
+        guild = self.world.guild_of_channel(message.channel_id)
+        self.feed( "MESSAGE_REACTION_REMOVE", { "user_id": str(user_id),
+            "channel_id": str(message.channel_id),
+            "message_id": str(message.id), "guild_id": str(guild.id),
+            "emoji": {"id": None, "name": emoji},
+            "burst": False, "type": 0 })
+
+    def emit_reaction_clear_emoji(self, message, emoji):
+        self.events["reaction_clear_emoji"] += 1
+        guild = self.world.guild_of_channel(message.channel_id)
+        self.feed( "MESSAGE_REACTION_REMOVE_EMOJI", {
+            "channel_id": str(message.channel_id),
+            "message_id": str(message.id), "guild_id": str(guild.id),
+            "emoji": {"id": None, "name": emoji} })
+
+    def emit_reaction_clear(self, message):
+        self.events["reaction_clear"] += 1
+        guild = self.world.guild_of_channel(message.channel_id)
+        self.feed( "MESSAGE_REACTION_REMOVE_ALL", {
+            "channel_id": str(message.channel_id),
+            "message_id": str(message.id), "guild_id": str(guild.id) })
+
+    # actions of users
+
+    def post(self, user_id, channel_id, content="задачи 1, 2", *,
+        mention_bot=False,
+    ):
+        mentions = ()
+        if mention_bot:
+            content = f"<@!{self.world.bot_id}> {content}"
+            mentions = (self.world.bot_id,)
+        message = self.create_message( channel_id, user_id, content,
+            mentions=mentions )
+        self.emit_message(message)
+        return message
+
+    def delete(self, message):
+        self.remove_message(message)
+        self.emit_message_delete(message)
+
+    def delete_bulk(self, messages):
+        # messages of one channel
+        for message in messages:
+            self.remove_message(message)
+        self.emit_message_delete_bulk(messages)
+
+    def move(self, guild, user_id, channel_id):
+        guild.members[user_id].voice = channel_id
+        self.emit_voice(guild, user_id)
+
+    def react(self, user_id, message, emoji):
+        users = message.reactions.setdefault(emoji, set())
+        if user_id in users:
+            return
+        users.add(user_id)
+        self.emit_reaction_add(message, user_id, emoji)
+
+    def unreact(self, user_id, message, emoji):
+        users = message.reactions.get(emoji, set())
+        if user_id not in users:
+            return
+        users.discard(user_id)
+        self.emit_reaction_remove(message, user_id, emoji)
+
+    def clear_reactions(self, message):
+        message.reactions.clear()
+        self.emit_reaction_clear(message)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# Replays a recording made with `queue_bot.py --record` against QueueBot
+# on the fake gateway, and reports the same numbers as bench_events.py.
+# Rotated files are given oldest first:
+#
+#     python3 bench/replay.py events.jsonl.2 events.jsonl.1 events.jsonl
+#     python3 bench/replay.py --speed 10 events.jsonl
+#     python3 bench/replay.py --step events.jsonl
+
+import os
+import sys
+import argparse
+import asyncio
+import time
+import json
+import logging
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord
+
+import queue_bot
+from fake_discord import ( World, FakeGuild, FakeChannel, FakeMember,
+    FakeMessage, FakeGateway, RateLimits )
+from bench_events import Probe, percentile_ms, print_results
+
+class ReplayWorld(World):
+    # a world that follows the recorded events, so that REST calls of
+    # the bot are answered as Discord would have answered them
+
+    def __init__(self, bot_user):
+        super().__init__()
+        self.bot_id = int(bot_user["id"])
+        self.users = {self.bot_id: bot_user}
+
+    def apply(self, event, data):
+        method = getattr(self, "apply_" + event.lower(), None)
+        if method is not None:
+            method(data)
+
+    def guild(self, data):
+        return self.guilds.get(int(data.get("guild_id", 0)))
+
+    def apply_guild_create(self, data):
+        guild = FakeGuild(int(data["id"]), data.get("name"))
+        for role in data.get("roles", ()):
+            if int(role["id"]) != guild.id:
+                guild.roles[int(role["id"])] = role["name"]
+        for channel in data.get("channels", ()):
+            guild.channels[int(channel["id"])] = self.channel(channel)
+        for member in data.get("members", ()):
+            self.apply_member(guild, member)
+        for voice in data.get("voice_states", ()):
+            member = guild.members.get(int(voice["user_id"]))
+            if member is not None and voice.get("channel_id") is not None:
+                member.voice = int(voice["channel_id"])
+        previous = self.guilds.get(guild.id)
+        if previous is not None:
+            for channel_id, channel in previous.channels.items():
+                if channel_id in guild.channels:
+                    guild.channels[channel_id].messages = channel.messages
+        self.guilds[guild.id] = guild
+
+    def apply_guild_delete(self, data):
+        if not data.get("unavailable"):
+            self.guilds.pop(int(data["id"]), None)
+
+    @staticmethod
+    def channel(data):
+        parent_id = data.get("parent_id")
+        return FakeChannel( int(data["id"]), data.get("name"),
+            type=data["type"], position=data.get("position", 0),
+            parent_id=None if parent_id is None else int(parent_id) )
+
+    def apply_member(self, guild, data):
+        user_id = int(data["user"]["id"])
+        self.users[user_id] = data["user"]
+        member = guild.members.get(user_id)
+        roles = tuple(int(role) for role in data.get("roles", ()))
+        if member is None:
+            member = guild.members[user_id] = FakeMember(user_id, roles)
+        member.roles = roles
+
+    def apply_guild_member_add(self, data):
+        guild = self.guild(data)
+        if guild is not None:
+            self.apply_member(guild, data)
+
+    apply_guild_member_update = apply_guild_member_add
+
+    def apply_guild_member_remove(self, data):
+        guild = self.guild(data)
+        if guild is not None:
+            guild.members.pop(int(data["user"]["id"]), None)
+
+    def apply_guild_role_create(self, data):
+        guild = self.guild(data)
+        if guild is not None:
+            guild.roles[int(data["role"]["id"])] = data["role"]["name"]
+
+    apply_guild_role_update = apply_guild_role_create
+
+    def apply_guild_role_delete(self, data):
+        guild = self.guild(data)
+        if guild is not None:
+            guild.roles.pop(int(data["role_id"]), None)
+
+    def apply_channel_create(self, data):
+        guild = self.guild(data)
+        if guild is None:
+            return
+        channel = self.channel(data)
+        previous = guild.channels.get(channel.id)
+        if previous is not None:
+            channel.messages = previous.messages
+        guild.channels[channel.id] = channel
+
+    apply_channel_update = apply_channel_create
+
+    def apply_channel_delete(self, data):
+        guild = self.guild(data)
+        if guild is not None:
+            guild.channels.pop(int(data["id"]), None)
+
+    def apply_message_create(self, data):
+        guild = self.guild(data)
+        if guild is None or int(data["channel_id"]) not in guild.channels:
+            return
+        author = data["author"]
+        self.users[int(author["id"])] = author
+        for user in data.get("mentions", ()):
+            self.users.setdefault(int(user["id"]), user)
+        message = FakeMessage( int(data["id"]), int(data["channel_id"]),
+            int(author["id"]), data.get("content", ""),
+            tuple(int(user["id"]) for user in data.get("mentions", ())) )
+        guild.channels[message.channel_id].messages.append(message)
+        self.messages[message.id] = message
+
+    def apply_message_delete(self, data):
+        self.delete_message(int(data["id"]))
+
+    def apply_message_delete_bulk(self, data):
+        for message_id in data["ids"]:
+            self.delete_message(int(message_id))
+
+    def delete_message(self, message_id):
+        message = self.messages.pop(message_id, None)
+        if message is None:
+            return
+        guild = self.guild_of_channel(message.channel_id)
+        guild.channels[message.channel_id].messages.remove(message)
+
+    def apply_voice_state_update(self, data):
+        guild = self.guild(data)
+        if guild is None:
+            return
+        if "member" in data:
+            self.apply_member(guild, data["member"])
+        member = guild.members.get(int(data["user_id"]))
+        if member is None:
+            return
+        channel_id = data.get("channel_id")
+        member.voice = None if channel_id is None else int(channel_id)
+
+    @staticmethod
+    def emoji(data):
+        emoji = data["emoji"]
+        if emoji.get("id") is None:
+            return emoji["name"]
+        return f"{emoji['name']}:{emoji['id']}"
+
+    def apply_message_reaction_add(self, data):
+        message = self.messages.get(int(data["message_id"]))
+        if message is not None:
+            message.reactions.setdefault(self.emoji(data), set()).add(
+                int(data["user_id"]) )
+
+    def apply_message_reaction_remove(self, data):
+        message = self.messages.get(int(data["message_id"]))
+        if message is not None:
+            message.reactions.get(self.emoji(data), set()).discard(
+                int(data["user_id"]) )
+
+    def apply_message_reaction_remove_emoji(self, data):
+        message = self.messages.get(int(data["message_id"]))
+        if message is not None:
+            message.reactions.pop(self.emoji(data), None)
+
+    def apply_message_reaction_remove_all(self, data):
+        message = self.messages.get(int(data["message_id"]))
+        if message is not None:
+            message.reactions.clear()
+
+def read_recording(paths):
+    # (milliseconds since the Discord epoch, event, data)
+    for path in paths:
+        start = None
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                line = json.loads(line)
+                if isinstance(line, dict):
+                    start = line["start"]
+                    continue
+                if start is None:
+                    raise ValueError(f"{path}: recording without a header")
+                offset, event, data = line
+                yield start + offset, event, data
+
+def rebase(events):
+    # move the recording to the present, as if it had just started
+    if not events:
+        return events
+    shift = ( discord.utils.time_snowflake(discord.utils.utcnow()) >> 22 ) \
+        - events[0][0]
+    def snowflake(value):
+        return value + (shift << 22)
+    return [ ( at + shift, event, queue_bot.QueueBot.Recorder.rewrite(
+            data, snowflake, shift ) )
+        for at, event, data in events ]
+
+async def replay(args):
+    events = rebase(list(read_recording(args.recording)))
+    ready = next((data for _, event, data in events if event == "READY"), None)
+    if ready is None:
+        raise ValueError("the recording has no READY event")
+    world = ReplayWorld(ready["user"])
+    limits = RateLimits( latency=args.latency,
+        bucket_interval=args.bucket_interval,
+        global_interval=args.global_interval )
+    bot = queue_bot.QueueBot( state_file=args.state_file,
+        coalesce_window=args.coalesce_window,
+        reconcile_concurrency=args.reconcile_concurrency )
+    gateway = FakeGateway(bot, world, limits=limits)
+    probe = Probe(bot)
+    await gateway.connect()
+    recorded = Counter()
+    start = time.perf_counter()
+    previous = None
+    for at, event, data in events:
+        if event == "READY":
+            continue
+        if args.step:
+            await gateway.settle()
+        elif args.speed and previous is not None:
+            delay = min((at - previous) / 1000, args.max_gap) / args.speed
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+        previous = at
+        world.apply(event, data)
+        recorded[event] += 1
+        gateway.feed(event, data)
+    await gateway.settle()
+    duration = time.perf_counter() - start
+    await bot.close()
+    events_count = sum(recorded.values())
+    calls = gateway.http.calls
+    result = {
+        "events": events_count,
+        "events_by_kind": dict(sorted(recorded.items())),
+        # caused by the writes of the bot
+        "echoed_events": sum(gateway.events.values()),
+        "seconds": round(duration, 3),
+        "events_per_second": round(events_count / duration, 1)
+            if events_count else None,
+        "rest_calls": sum(calls.values()),
+        "rest_calls_per_event": round(sum(calls.values()) / events_count, 3)
+            if events_count else None,
+        "rest_calls_by_kind": dict(sorted(calls.items())),
+        "rate_limit_hits": limits.hits,
+    }
+    for name in ("handlers",) + Probe.METHODS:
+        latencies = sorted(probe.latencies.get(name, ()))
+        result[name] = len(latencies)
+        result[f"{name}_p50_ms"] = percentile_ms(latencies, 0.50)
+        result[f"{name}_p99_ms"] = percentile_ms(latencies, 0.99)
+    return {"replay": result}
+
+def main():
+    parser = argparse.ArgumentParser("Replay a QueueBot recording")
+    parser.add_argument("recording", nargs="+",
+        help="recording files, oldest first" )
+    parser.add_argument("--speed", type=float, default=1.0,
+        help="replay this many times faster than recorded "
+            "(0 for no waiting at all)" )
+    parser.add_argument("--max-gap", type=float, default=5.0,
+        help="longest pause between events, in recorded seconds" )
+    parser.add_argument("--step", action="store_true",
+        help="let the bot settle after every event, "
+            "for a deterministic order of everything" )
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bucket-interval", type=float, default=0.0)
+    parser.add_argument("--global-interval", type=float, default=0.0)
+    parser.add_argument("--state-file")
+    parser.add_argument("--coalesce-window", type=float,
+        default=queue_bot.COALESCE_WINDOW )
+    parser.add_argument("--reconcile-concurrency", type=int,
+        default=queue_bot.RECONCILE_CONCURRENCY )
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(replay(args))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_results(results)
+
+if __name__ == '__main__':
+    main()
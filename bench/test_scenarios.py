@@ -0,0 +1,579 @@
+# Scripted scenarios on the fake Discord, checking the reactions that
+# the bot leaves on queue messages, and what it records and saves.
+#
+#     python3 -m pytest bench
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import functools
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import queue_bot
+from queue_bot import EMOJI_ASTRAY, EMOJI_ACTIVE, EMOJI_FINISHED, EMOJI_IGNORED
+from fake_discord import World, FakeGateway, RateLimits
+import replay
+
+logging.getLogger("queue_bot").setLevel(logging.ERROR)
+
+class Course:
+
+    def __init__(self, *, students=2, world=None, shard=None, **kwargs):
+        # courses of one world are servers of the same bot
+        self.world = world = world if world is not None else World()
+        self.guild = guild = world.add_guild("Курс", shard=shard)
+        teacher_role = world.add_role(guild, "Преподаватель")
+        self.text = world.add_channel(guild, "очередь")
+        self.queue_voice = world.add_channel(guild, "Очередь", voice=True)
+        self.room = world.add_channel(guild, "Комната", voice=True)
+        self.teacher = world.add_member( guild, "teacher",
+            roles=[teacher_role] )
+        guild.members[self.teacher].voice = self.room
+        self.students = [ world.add_member(guild, f"student{i}")
+            for i in range(students) ]
+        self.kwargs = kwargs
+
+    def start(self, *, latency=0.0, client=queue_bot.QueueBot, **kwargs):
+        self.bot = client(**{**self.kwargs, **kwargs})
+        self.gateway = FakeGateway( self.bot, self.world,
+            limits=RateLimits(latency=latency) )
+        return self.gateway
+
+    def own(self, message):
+        # our reactions on the message
+        return { emoji for emoji, users in message.reactions.items()
+            if self.world.bot_id in users }
+
+def run(scenario):
+    asyncio.run(scenario())
+
+def test_sign_up():
+    course = Course(students=3, coalesce_window=0)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        first, second, third = course.students
+        gateway.move(guild, first, course.queue_voice)
+        messages = [ gateway.post(student, course.text)
+            for student in course.students ]
+        await gateway.settle()
+        assert course.own(messages[0]) == set()
+        assert course.own(messages[1]) == {EMOJI_ASTRAY}
+        gateway.move(guild, second, course.room)
+        again = gateway.post(third, course.text)
+        await gateway.settle()
+        assert course.own(messages[1]) == {EMOJI_ACTIVE}
+        assert course.own(again) == {EMOJI_IGNORED}
+        gateway.move(guild, second, None)
+        await gateway.settle()
+        assert course.own(messages[1]) == {EMOJI_FINISHED}
+        await course.bot.close()
+    run(scenario)
+
+def test_next_moves_first_waiting():
+    course = Course(students=2, coalesce_window=0)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        messages = list()
+        for student in course.students:
+            gateway.move(guild, student, course.queue_voice)
+            messages.append(gateway.post(student, course.text))
+            await gateway.settle()
+        gateway.post( course.teacher, course.text, "следующий",
+            mention_bot=True )
+        await gateway.settle()
+        first, second = course.students
+        assert guild.members[first].voice == course.room
+        assert guild.members[second].voice == course.queue_voice
+        assert course.own(messages[0]) == {EMOJI_ACTIVE}
+        gateway.move(guild, first, None)
+        await gateway.settle()
+        assert course.own(messages[0]) == {EMOJI_FINISHED}
+        assert course.own(messages[1]) == set()
+        await course.bot.close()
+    run(scenario)
+
+def test_wish_changes_during_write():
+    # the student joins the queue while our 😠 is being written
+    course = Course(students=1, coalesce_window=0)
+    async def scenario():
+        gateway = course.start(latency=0.3)
+        await gateway.connect()
+        student, = course.students
+        message = gateway.post(student, course.text)
+        while not gateway.http.in_flight:
+            await asyncio.sleep(0.01)
+        gateway.move(course.guild, student, course.queue_voice)
+        await gateway.settle()
+        assert course.own(message) == set()
+        queue_state = course.bot.queue_states[course.guild.id][student]
+        assert queue_state.status == "normal"
+        await course.bot.close()
+    run(scenario)
+
+def test_outbox_merge_does_latest():
+    # a merged write is done with the action submitted last, which
+    # holds the message now in the cache
+    async def scenario():
+        outbox = queue_bot.QueueBot.Outbox(1)
+        done = list()
+        async def write(name):
+            done.append(name)
+        first = outbox.submit( outbox.REACTION, "bucket",
+            functools.partial(write, "first") )
+        old = outbox.submit( outbox.REACTION, "bucket",
+            functools.partial(write, "old"), key="message" )
+        new = outbox.submit( outbox.REACTION, "bucket",
+            functools.partial(write, "new"), key="message" )
+        assert new is old
+        await asyncio.gather(first, new)
+        assert done == ["first", "new"]
+    run(scenario)
+
+def test_warm_restart(tmp_path, monkeypatch):
+    # the history is read from the stored marks on, and only a batch of
+    # the restored messages is fetched, of waiting students first
+    monkeypatch.setattr(queue_bot, "RECONSIDER_FETCH_LIMIT", 5)
+    course = Course( students=20, coalesce_window=0,
+        state_file=str(tmp_path / "state.sqlite") )
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        messages = list()
+        for i, student in enumerate(course.students):
+            if i % 2:
+                gateway.move(guild, student, course.queue_voice)
+            messages.append(gateway.post(student, course.text))
+        await gateway.settle()
+        await course.bot.close()
+        gateway.remove_message(messages[-1])
+        later = gateway.create_message( course.text, course.students[-3],
+            "задача 3" )
+        gateway = course.start()
+        await gateway.connect()
+        assert gateway.http.calls["logs_from"] == 1
+        # the previous message of the student who has posted again,
+        # and the batch
+        assert gateway.http.calls["get_message"] == 1 + 5
+        guild_states = course.bot.queue_states[guild.id]
+        assert guild_states[course.students[-1]].messages() == []
+        assert course.own(later) == {EMOJI_IGNORED}
+        for i, message in enumerate(messages[:-1]):
+            assert course.own(message) == \
+                (set() if i % 2 else {EMOJI_ASTRAY})
+        assert course.bot.queue_states[guild.id][course.students[0]] \
+            .status == "astray"
+        await course.bot.close()
+    run(scenario)
+
+@pytest.mark.parametrize("fetch_limit", [50, 0])
+def test_deleted_during_outage(monkeypatch, fetch_limit):
+    # the first student's message is deleted while the server is
+    # unavailable, and the event is never seen; the message is found
+    # gone when the server is back, or else by «следующий»
+    monkeypatch.setattr(queue_bot, "RECONSIDER_FETCH_LIMIT", fetch_limit)
+    course = Course(students=2, coalesce_window=0)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        messages = list()
+        for student in course.students:
+            gateway.move(guild, student, course.queue_voice)
+            messages.append(gateway.post(student, course.text))
+            await gateway.settle()
+        gateway.feed("GUILD_DELETE", {"id": guild.id, "unavailable": True})
+        await gateway.settle()
+        gateway.remove_message(messages[0])
+        calls = dict(gateway.http.calls)
+        gateway.feed("GUILD_CREATE", course.world.guild_payload(guild))
+        await gateway.settle()
+        assert gateway.http.calls["logs_from"] == calls["logs_from"] + 1
+        assert gateway.http.calls["get_message"] == \
+            calls.get("get_message", 0) + min(2, fetch_limit)
+        gateway.post( course.teacher, course.text, "следующий",
+            mention_bot=True )
+        await gateway.settle()
+        first, second = course.students
+        assert guild.members[first].voice == course.queue_voice
+        assert guild.members[second].voice == course.room
+        await course.bot.close()
+    run(scenario)
+
+def test_record_leaves_out_echoes(tmp_path):
+    # the move and the deleted command are done again by a replaying bot
+    record_file = tmp_path / "events.jsonl"
+    course = Course( students=1, coalesce_window=0,
+        record_file=str(record_file) )
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        student, = course.students
+        gateway.move(guild, student, course.queue_voice)
+        gateway.post(student, course.text)
+        await gateway.settle()
+        command = gateway.post( course.teacher, course.text, "следующий",
+            mention_bot=True )
+        await gateway.settle()
+        assert guild.members[student].voice == course.room
+        await course.bot.close()
+        events = [ tuple(line[1:]) for line in map( json.loads,
+                record_file.read_text(encoding="utf-8").splitlines() )
+            if isinstance(line, list) ]
+        voice = [ data["channel_id"] for event, data in events
+            if event == "VOICE_STATE_UPDATE" ]
+        assert voice == [str(course.queue_voice)]
+        assert not any( event == "MESSAGE_DELETE"
+            for event, data in events )
+        assert any( event == "MESSAGE_CREATE" and
+            data["id"] == str(command.id) for event, data in events )
+    run(scenario)
+
+def test_failed_flush_is_retried(tmp_path):
+    store = queue_bot.QueueBot.StateStore(str(tmp_path / "state.sqlite"))
+    write = store.write
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+    async def scenario():
+        store.note_guild(1, time.monotonic())
+        store.note_mark(1, 2, 3)
+        store.write = locked
+        with pytest.raises(sqlite3.OperationalError):
+            await store.flush()
+        store.note_mark(1, 2, 4)
+        store.write = write
+        await store.flush()
+        atime, _, marks = await store.load_guild(1)
+        assert atime is not None
+        assert marks == {2: 4}
+    run(scenario)
+
+def test_close_waits_for_flush(tmp_path):
+    # the periodic flush is cancelled while its write is in a thread;
+    # the final flush is done after it, not along with it
+    store = queue_bot.QueueBot.StateStore(str(tmp_path / "state.sqlite"))
+    write = store.write
+    writing = list()
+    def slow(*args):
+        writing.append(args)
+        assert len(writing) == 1
+        time.sleep(0.2)
+        write(*args)
+        writing.pop()
+    async def scenario():
+        store.note_mark(1, 2, 3)
+        store.write = slow
+        flush = asyncio.create_task(store.flush())
+        while not writing:
+            await asyncio.sleep(0.01)
+        flush.cancel()
+        store.note_mark(1, 2, 4)
+        await store.close()
+        assert not writing
+        reopened = queue_bot.QueueBot.StateStore(
+            str(tmp_path / "state.sqlite") )
+        _, _, marks = await reopened.load_guild(1)
+        assert marks == {2: 4}
+        await reopened.close()
+    run(scenario)
+
+def test_record_leaves_out_reaction_echoes(tmp_path):
+    record_file = tmp_path / "events.jsonl"
+    course = Course( students=1, coalesce_window=0,
+        record_file=str(record_file) )
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        student, = course.students
+        message = gateway.post(student, course.text)
+        await gateway.settle()
+        assert course.own(message) == {EMOJI_ASTRAY}
+        gateway.move(course.guild, student, course.queue_voice)
+        await gateway.settle()
+        assert course.own(message) == set()
+        await course.bot.close()
+    run(scenario)
+    events = [ line[1] for line in map( json.loads,
+            record_file.read_text(encoding="utf-8").splitlines() )
+        if isinstance(line, list) ]
+    assert "MESSAGE_REACTION_ADD" not in events
+    assert "MESSAGE_REACTION_REMOVE_EMOJI" not in events
+    assert course.bot.recorder.echoes == {}
+
+def test_record_rotation(tmp_path, monkeypatch):
+    # every file starts with the servers, and can be replayed alone
+    monkeypatch.setattr(queue_bot, "RECORD_MAX_BYTES", 4096)
+    record_file = tmp_path / "events.jsonl"
+    course = Course( students=4, coalesce_window=0,
+        record_file=str(record_file) )
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        for student in course.students:
+            gateway.post(student, course.text)
+        for _ in range(5):
+            for student in course.students:
+                gateway.move(guild, student, course.room)
+                gateway.move(guild, student, course.queue_voice)
+            await gateway.settle()
+        await course.bot.close()
+    run(scenario)
+    assert (tmp_path / "events.jsonl.2").exists()
+    events = list(replay.read_recording([str(record_file)]))
+    assert [event for _, event, _ in events[:2]] == ["READY", "GUILD_CREATE"]
+    ready, = [data for _, event, data in events if event == "READY"]
+    world = replay.ReplayWorld(ready["user"])
+    for _, event, data in events:
+        world.apply(event, data)
+    guild = world.guilds[course.guild.id]
+    for student in course.students:
+        assert guild.members[student].voice == course.queue_voice
+    asyncio.run(replay.replay(argparse.Namespace(
+        recording=[str(record_file)], speed=0, max_gap=5.0, step=False,
+        latency=0.0, bucket_interval=0.0, global_interval=0.0,
+        state_file=None, coalesce_window=0, reconcile_concurrency=4 )))
+
+def test_record_bulk_delete_anonymized(tmp_path):
+    record_file = tmp_path / "events.jsonl"
+    course = Course( students=2, coalesce_window=0,
+        record_file=str(record_file), record_key="secret" )
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        messages = [ gateway.post(student, course.text)
+            for student in course.students ]
+        await gateway.settle()
+        gateway.delete_bulk(messages)
+        await gateway.settle()
+        guild_states = course.bot.queue_states[course.guild.id]
+        assert all( not queue_state.messages()
+            for queue_state in guild_states.values() )
+        await course.bot.close()
+        return messages
+    messages = asyncio.run(scenario())
+    events = list(replay.read_recording([str(record_file)]))
+    created = { data["id"] for _, event, data in events
+        if event == "MESSAGE_CREATE" }
+    deleted, = [ data["ids"] for _, event, data in events
+        if event == "MESSAGE_DELETE_BULK" ]
+    assert set(deleted) == created
+    assert created.isdisjoint(str(message.id) for message in messages)
+    # the rebased deletion still matches the rebased messages
+    events = replay.rebase(events)
+    ready, = [data for _, event, data in events if event == "READY"]
+    world = replay.ReplayWorld(ready["user"])
+    for _, event, data in events:
+        world.apply(event, data)
+    assert not world.messages
+    results = asyncio.run(replay.replay(argparse.Namespace(
+        recording=[str(record_file)], speed=0, max_gap=5.0, step=True,
+        latency=0.0, bucket_interval=0.0, global_interval=0.0,
+        state_file=None, coalesce_window=0, reconcile_concurrency=4 )))
+    assert results["replay"]["events_by_kind"]["MESSAGE_DELETE_BULK"] == 1
+    recorder = queue_bot.QueueBot.Recorder(None, key="secret")
+    data = recorder.rewrite( { "attachments": [{"filename": "a.png"}],
+            "embeds": [{"url": "https://example.com"}],
+            "mention_roles": ["42"] },
+        recorder.scramble, recorder.time_shift,
+        pseudonym=recorder.pseudonym )
+    assert data["attachments"] == data["embeds"] == []
+    assert data["mention_roles"] != ["42"]
+
+def test_flood_is_caught_up():
+    # more messages than fit wait for room; the rest are shed, and read
+    # from the history once the queue has room again
+    course = Course( students=40, coalesce_window=0,
+        event_queue_size=4, event_workers=1 )
+    async def scenario():
+        gateway = course.start(latency=0.01)
+        await gateway.connect()
+        guild = course.guild
+        for student in course.students[::2]:
+            gateway.move(guild, student, course.queue_voice)
+        await gateway.settle()
+        inbox = course.bot.inbox
+        waiting = list()
+        async def watch():
+            while True:
+                waiting.append(len(inbox.waiters.get(guild.id, ())))
+                await asyncio.sleep(0)
+        watcher = asyncio.create_task(watch())
+        messages = [ gateway.post(student, course.text)
+            for student in course.students ]
+        await gateway.settle()
+        watcher.cancel()
+        assert max(waiting) <= 4
+        assert course.bot.metrics.events_shed["message", "overflow"] > 0
+        for index, message in enumerate(messages):
+            assert course.own(message) == \
+                (set() if index % 2 == 0 else {EMOJI_ASTRAY})
+        assert not course.bot.missed_messages
+        await course.bot.close()
+    run(scenario)
+
+def test_deleted_messages_are_forgotten():
+    course = Course(students=3, coalesce_window=0)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        messages = list()
+        for student in course.students:
+            gateway.move(guild, student, course.queue_voice)
+            messages.append(gateway.post(student, course.text))
+        await gateway.settle()
+        index = course.bot.queue_index
+        gateway.delete(messages[0])
+        gateway.delete_bulk(messages[1:])
+        await gateway.settle()
+        assert all( index.owner(message.id) is None
+            for message in messages )
+        assert not index.queue(course.text)
+        gateway.post( course.teacher, course.text, "следующий",
+            mention_bot=True )
+        await gateway.settle()
+        assert all( guild.members[student].voice == course.queue_voice
+            for student in course.students )
+        await course.bot.close()
+    run(scenario)
+
+def test_updates_shed():
+    # student updates are shed from a full queue, and done once it has
+    # room again
+    course = Course( students=20, coalesce_window=0,
+        event_queue_size=2, event_workers=1 )
+    async def scenario():
+        gateway = course.start(latency=0.01)
+        await gateway.connect()
+        guild = course.guild
+        messages = [ gateway.post(student, course.text)
+            for student in course.students ]
+        await gateway.settle()
+        for hop in range(3):
+            for student in course.students:
+                gateway.move( guild, student,
+                    course.room if hop % 2 == 0 else course.queue_voice )
+        await gateway.settle()
+        shed = course.bot.metrics.events_shed
+        assert shed["update", "overflow"] > 0
+        for message in messages:
+            assert course.own(message) == {EMOJI_ACTIVE}
+        assert not course.bot.pending_updates
+        assert not course.bot.inbox.damaged
+        await course.bot.close()
+    run(scenario)
+
+def test_expiry(monkeypatch):
+    # a queue state left alone for TIME_LIMIT_CLEAN is forgotten, and
+    # its message marked as ignored
+    monkeypatch.setattr(queue_bot, "TIME_LIMIT_CLEAN", 0.2)
+    monkeypatch.setattr(queue_bot, "TIME_EPSILON", 0)
+    course = Course(students=1, coalesce_window=0)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        student, = course.students
+        message = gateway.post(student, course.text)
+        await gateway.settle()
+        assert course.own(message) == {EMOJI_ASTRAY}
+        await asyncio.sleep(0.3)
+        await gateway.settle()
+        assert student not in course.bot.queue_states.get(course.guild.id, {})
+        assert course.bot.queue_index.owner(message.id) is None
+        assert course.own(message) == {EMOJI_IGNORED}
+        await course.bot.close()
+    run(scenario)
+
+def test_lean_members():
+    # students out of voice channels are not cached, and queues work
+    # the same
+    course = Course(students=3, coalesce_window=0, lean_members=True)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        first, second, third = course.students
+        gateway.move(guild, first, course.queue_voice)
+        messages = [ gateway.post(student, course.text)
+            for student in course.students ]
+        await gateway.settle()
+        cached = course.bot.get_guild(guild.id)
+        assert cached.get_member(third) is None
+        assert course.own(messages[0]) == set()
+        assert course.own(messages[2]) == {EMOJI_ASTRAY}
+        gateway.move(guild, second, course.queue_voice)
+        gateway.move(guild, first, course.room)
+        await gateway.settle()
+        gateway.move(guild, first, None)
+        await gateway.settle()
+        assert course.own(messages[0]) == {EMOJI_FINISHED}
+        assert course.own(messages[1]) == set()
+        assert cached.get_member(first) is None
+        await course.bot.close()
+    run(scenario)
+
+def test_shards():
+    # servers on two shards of one AutoShardedClient
+    world = World()
+    courses = [ Course(students=1, world=world, shard=(shard_id, 2))
+        for shard_id in range(2) ]
+    async def scenario():
+        gateway = courses[0].start( client=queue_bot.ShardedQueueBot,
+            coalesce_window=0, shard_count=2, shard_ids=[0, 1] )
+        await gateway.connect()
+        bot = courses[0].bot
+        messages = list()
+        for course in courses:
+            student, = course.students
+            messages.append(gateway.post(student, course.text))
+        await gateway.settle()
+        for shard_id, (course, message) in \
+                enumerate(zip(courses, messages)):
+            assert bot.get_guild(course.guild.id).shard_id == shard_id
+            assert bot.shard_of(course.guild.id) == shard_id
+            assert course.own(message) == {EMOJI_ASTRAY}
+        assert sorted(bot.reconciliations) == [0, 1]
+        assert sorted(bot.student_activity) == [0, 1]
+        await bot.close()
+    run(scenario)
+
+def test_metrics():
+    course = Course(students=2, coalesce_window=0)
+    async def scenario():
+        gateway = course.start()
+        await gateway.connect()
+        guild = course.guild
+        first, second = course.students
+        gateway.move(guild, first, course.queue_voice)
+        for student in course.students:
+            gateway.post(student, course.text)
+        await gateway.settle()
+        lines = course.bot.metrics.render().splitlines()
+        assert ( 'queue_bot_handler_seconds_count'
+            '{handler="on_voice_state_update",stage="dispatch"} 1' ) in lines
+        assert ( 'queue_bot_handler_seconds_count'
+            '{handler="consider_new_message",stage="run"} 2' ) in lines
+        assert ( 'queue_bot_queue_states'
+            f'{{shard_id="0",guild_id="{guild.id}"}} 2' ) in lines
+        # REST calls are counted on the aiohttp session, which the fake
+        # Discord does not use
+        assert "# TYPE queue_bot_rest_calls_total counter" in lines
+        assert any( line.startswith("queue_bot_student_mailbox_wait_seconds")
+            for line in lines )
+        await course.bot.close()
+    run(scenario)
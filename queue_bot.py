@@ -1,13 +1,30 @@
 import os
+import sys
 import argparse
 import asyncio
+import threading
+import traceback
 import time
-from datetime import timedelta
+import sqlite3
+import functools
+import copy
+import queue
+import multiprocessing
+import bisect
+import heapq
+import itertools
+import json
+import hmac
+import re
+from datetime import datetime, timedelta
+from collections import OrderedDict, Counter, defaultdict, deque
 
 import logging, logging.handlers
 _LOGGER = logging.getLogger(__name__)
 
 import discord
+import aiohttp
+from aiohttp import web
 
 EMOJI_ASTRAY = "\N{ANGRY FACE}"
 EMOJI_ACTIVE = "\N{FACE WITH MONOCLE}"
@@ -75,19 +92,149 @@ TIME_LIMIT_CLEAN  = 60 * 60 * 24 * 7
 TIME_LIMIT_ACTIVE = 60 * 60
 TIME_EPSILON = 10
 
+MESSAGE_CACHE_SIZE = 4096
+
+STATE_FLUSH_INTERVAL = 5
+HISTORY_MARK_LIMIT = TIME_LIMIT_CLEAN
+
+MEMBER_QUERY_SIZE = 100
+# as fetched by discord.py
+HISTORY_PAGE_SIZE = 100
+
+RECONCILE_CONCURRENCY = 4
+# tracked messages that the history has not shown, fetched again
+# when a server is reconsidered
+RECONSIDER_FETCH_LIMIT = 50
+RECONCILE_PROGRESS_INTERVAL = 10
+
+COALESCE_WINDOW = 0.5
+COALESCE_MAX_DELAY = 2
+
+OUTBOX_CONCURRENCY = 8
+
+EVENT_WORKERS = 4
+EVENT_QUEUE_SIZE = 256
+
+RECORD_MAX_BYTES = 1 << 24
+RECORD_BACKUP_COUNT = 4
+RECORD_FLUSH_INTERVAL = 1
+RECORDED_EVENTS = frozenset({
+    "READY",
+    "GUILD_CREATE", "GUILD_DELETE",
+    "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+    "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE",
+    "GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE",
+    "MESSAGE_CREATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK",
+    "VOICE_STATE_UPDATE",
+    "MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE",
+    "MESSAGE_REACTION_REMOVE_ALL", "MESSAGE_REACTION_REMOVE_EMOJI",
+})
+
+METRICS_BUCKETS = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10 )
+
+HANDLER_BUDGET = 1
+LAG_INTERVAL = 0.1
+LAG_THRESHOLD = 0.25
+LAG_SAMPLE_INTERVAL = 0.005
+LAG_REPORT_STACKS = 5
+
+def measured(handler, *, stage="run"):
+    # the duration of every call goes to the metrics of the bot,
+    # and to the log if it is over the budget
+    @functools.wraps(handler)
+    async def measured_handler(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(self, *args, **kwargs)
+        finally:
+            self.observe_handler( handler.__name__,
+                time.perf_counter() - start, stage=stage )
+    return measured_handler
+
+def dispatching(handler):
+    # a gateway handler that only queues its work (which is measured
+    # when it is done) is measured apart, up to the queueing
+    return measured(handler, stage="dispatch")
+
 class QueueBot(discord.Client):
 
-    def __init__(self, *args, **kwargs):
+    def __init__( self, *args,
+        state_file=None, reconcile_concurrency=RECONCILE_CONCURRENCY,
+        coalesce_window=COALESCE_WINDOW,
+        record_file=None, record_key=None,
+        metrics_address=None,
+        diagnostics_file=None, lag_threshold=LAG_THRESHOLD,
+        handler_budget=HANDLER_BUDGET,
+        lean_members=False, chunk_members=True,
+        event_workers=EVENT_WORKERS, event_queue_size=EVENT_QUEUE_SIZE,
+        event_overflow="shed",
+        **kwargs
+    ):
         kwargs["intents"] = discord.Intents(
             guilds=True, members=True,
             messages=True, voice_states=True, reactions=True )
+        if lean_members:
+            # Only members in voice channels are cached by discord.py;
+            # students elsewhere are loaded when needed.  Chunking would
+            # download every member only to throw them away.
+            member_cache_flags = discord.MemberCacheFlags.none()
+            member_cache_flags.voice = True
+            kwargs["member_cache_flags"] = member_cache_flags
+            chunk_members = False
+        kwargs["chunk_guilds_at_startup"] = chunk_members
+        if record_file is not None:
+            kwargs["enable_debug_events"] = True
+        self.metrics = self.Metrics(metrics_address)
+        if metrics_address is not None:
+            kwargs["http_trace"] = self.metrics.trace_config()
         super().__init__(*args, **kwargs)
+        self.lean_members = lean_members
         self.queue_states = dict()
-        self.dict_lock = asyncio.Lock()
-        self.student_activity = self.StudentActivity()
+        # queue states with work in their mailbox
+        self.busy_students = set()
+        self.guild_locks = dict()
+        self.queue_index = self.QueueIndex()
+        self.expiry = self.ExpiryScheduler(self.expire)
+        self.state_store = self.StateStore(state_file)
+        # per shard
+        self.student_activity = dict()
+        self.message_cache = self.MessageCache()
+        self.classifications = dict()
+        self.reconcile_concurrency = reconcile_concurrency
+        self.reconciliations = dict()
+        self.coalesce_window = coalesce_window
+        self.pending_updates = dict()
+        # shed events, by guild id: the first missed message of every
+        # channel, and the latest reaction job of every message
+        self.missed_messages = dict()
+        self.missed_reactions = dict()
+        self.outbox = self.Outbox(OUTBOX_CONCURRENCY)
+        self.handler_budget = handler_budget
+        self.inbox = self.Inbox( event_queue_size, event_workers,
+            event_overflow, self.metrics.events_shed, self.repair_guild,
+            self.observe_handler )
+        self.recorder = self.Recorder(record_file, key=record_key)
+        self.watchdog = self.Watchdog( diagnostics_file, lag_threshold,
+            self.metrics.loop_lag )
 
     async def setup_hook(self):
-        self.student_activity.start_monitor()
+        self.state_store.start()
+        self.recorder.start()
+        await self.metrics.start(self.metrics_gauges)
+        self.watchdog.start()
+
+    async def close(self):
+        self.drop_pending_updates()
+        self.inbox.close()
+        self.outbox.close()
+        await super().close()
+        try:
+            await self.state_store.close()
+        finally:
+            await self.recorder.close()
+            await self.metrics.close()
+            self.watchdog.close()
 
     async def on_error(self, event, *args, **kwargs):
         def recover_guild(*args, **kwargs):
@@ -99,7 +246,9 @@ class QueueBot(discord.Client):
             def recover_guild(member, before, after):
                 if isinstance(member, discord.Member):
                     return member.guild
-        elif event == 'on_raw_reaction_add' or event == 'on_raw_reaction_remove':
+        elif event in { 'on_raw_reaction_add', 'on_raw_reaction_remove',
+                'on_raw_reaction_clear', 'on_raw_reaction_clear_emoji',
+                'on_raw_message_delete', 'on_raw_bulk_message_delete' }:
             def recover_guild(payload):
                 if payload.guild_id is not None:
                     return self.get_guild(payload.guild_id)
@@ -113,17 +262,116 @@ class QueueBot(discord.Client):
             prefix += f" (guild “{guild.name}”)"
         _LOGGER.exception(prefix, exc_info=True)
 
+    def shard_of(self, guild_id):
+        if self.shard_count is None:
+            return 0
+        return (guild_id >> 22) % self.shard_count
+
+    def guild_activity(self, guild):
+        shard_id = self.shard_of(guild.id)
+        try:
+            return self.student_activity[shard_id]
+        except KeyError:
+            activity = self.student_activity[shard_id] = \
+                self.StudentActivity( self.state_store, self.expiry,
+                    shard_id if self.shard_count is not None else None )
+            return activity
+
+    def reconciliation(self, guild):
+        # shards are reconciled independently of each other, so that a
+        # reconnecting shard does not wait behind the others
+        shard_id = self.shard_of(guild.id)
+        try:
+            return self.reconciliations[shard_id]
+        except KeyError:
+            reconciliation = self.reconciliations[shard_id] = \
+                self.Reconciliation(self.reconcile_concurrency)
+            return reconciliation
+
     class QueueState:
+        # The current message of a student in every queue channel, and
+        # whether it is finished.  Most students only ever post in one
+        # channel, so one message is kept as a plain tuple
+        # (channel_id, message_id, finished), and only more of them as
+        # a dict {channel_id: (message_id, finished)}.
+        # The mailbox and the drain task of the student are None while
+        # the student has nothing to do.
 
-        def __init__(self):
-            self.messages = dict()
-            self.finished = set()
+        __slots__ = ( "guild_id", "member_id", "mtime", "entries", "status",
+            "mailbox", "drain" )
+
+        def __init__(self, guild_id, member_id):
+            self.guild_id = guild_id
+            self.member_id = member_id
+            self.entries = None
+            # as of the last update_student, or None if unknown
+            self.status = None
             self.update()
-            self.lock = asyncio.Lock()
+            self.mailbox = None
+            self.drain = None
 
         def update(self):
             self.mtime = time.monotonic()
 
+        def messages(self):
+            # [(channel_id, message_id, finished)]
+            entries = self.entries
+            if entries is None:
+                return []
+            if type(entries) is tuple:
+                return [entries]
+            return [ (channel_id, message_id, finished)
+                for channel_id, (message_id, finished) in entries.items() ]
+
+        def get(self, channel_id):
+            entries = self.entries
+            if entries is None:
+                return None
+            if type(entries) is tuple:
+                return entries[1] if entries[0] == channel_id else None
+            entry = entries.get(channel_id)
+            return entry[0] if entry is not None else None
+
+        def put(self, channel_id, message_id, finished=False):
+            entries = self.entries
+            if entries is None or type(entries) is tuple and \
+                    entries[0] == channel_id:
+                self.entries = (channel_id, message_id, finished)
+            elif type(entries) is tuple:
+                self.entries = { entries[0]: entries[1:],
+                    channel_id: (message_id, finished) }
+            else:
+                entries[channel_id] = (message_id, finished)
+
+        def remove(self, channel_id):
+            entries = self.entries
+            if entries is None:
+                return
+            if type(entries) is tuple:
+                if entries[0] == channel_id:
+                    self.entries = None
+                return
+            entries.pop(channel_id, None)
+            if len(entries) == 1:
+                (channel_id, (message_id, finished)), = entries.items()
+                self.entries = (channel_id, message_id, finished)
+
+        def clear(self):
+            self.entries = None
+
+        def is_finished(self, message_id):
+            return any( finished
+                for _, entry_id, finished in self.messages()
+                if entry_id == message_id )
+
+        def any_finished(self):
+            return any(finished for _, _, finished in self.messages())
+
+        def set_finished(self, message_id, finished=True):
+            for channel_id, entry_id, _ in self.messages():
+                if entry_id == message_id:
+                    self.put(channel_id, message_id, finished)
+
     async def queue_state(self, guild, member):
         if not isinstance(member, int):
             if guild is None:
@@ -131,93 +379,315 @@ class QueueBot(discord.Client):
             member = member.id
         if not isinstance(guild, int):
             guild = guild.id
-        async with self.dict_lock:
-            try:
-                guild_states = self.queue_states[guild]
-            except KeyError:
-                guild_states = self.queue_states[guild] = dict()
-            try:
-                state = guild_states[member]
-            except KeyError:
-                state = guild_states[member] = self.QueueState()
-                asyncio.get_running_loop().create_task(
-                    self.clean_queue_state(guild, member, state) )
-            return state
-
-    async def clean_queue_state(self, guild_id, member_id, queue_state):
-        while True:
-            delta = queue_state.mtime + TIME_LIMIT_CLEAN - time.monotonic()
-            if delta > 0:
-                await asyncio.sleep(delta + TIME_EPSILON)
-                continue
-            break
-        async with self.dict_lock:
-            if guild_id not in self.queue_states:
-                return
+        try:
+            return self.queue_states[guild][member]
+        except KeyError:
+            return self.add_queue_state(guild, member)
+
+    def add_queue_state(self, guild_id, member_id):
+        try:
             guild_states = self.queue_states[guild_id]
-            if member_id not in guild_states:
-                return
-            if guild_states[member_id] is not queue_state:
+        except KeyError:
+            guild_states = self.queue_states[guild_id] = dict()
+        state = guild_states[member_id] = self.QueueState(guild_id, member_id)
+        self.schedule_clean(state)
+        return state
+
+    # Every student is an actor.  Whatever reads or changes their queue
+    # state is posted to the mailbox of the state, and done by its drain
+    # task, one after another; the task exists only while the mailbox
+    # is not empty.  Updates of the student that are found waiting
+    # together are merged into one, done after the rest of them.
+
+    class StudentUpdate:
+
+        def __init__(self, member, allow_finish, passed_active, snapshots):
+            self.member = member
+            self.allow_finish = allow_finish
+            self.passed_active = passed_active
+            self.snapshots = snapshots
+            self.future = asyncio.get_running_loop().create_future()
+
+    async def ask_student(self, queue_state, work):
+        # the result of work(queue_state), done in the student's turn
+        if asyncio.current_task() is queue_state.drain:
+            return await work(queue_state)
+        future = asyncio.get_running_loop().create_future()
+        self.post_student(queue_state, (work, future))
+        return await future
+
+    def post_student(self, queue_state, message):
+        if queue_state.mailbox is None:
+            queue_state.mailbox = deque()
+            queue_state.drain = asyncio.create_task(
+                self.drain_student(queue_state),
+                name=f"queue-bot: student "
+                    f"{queue_state.guild_id}/{queue_state.member_id}" )
+            self.busy_students.add(queue_state)
+        queue_state.mailbox.append((time.perf_counter(), message))
+
+    async def drain_student(self, queue_state):
+        mailbox = queue_state.mailbox
+        try:
+            while mailbox:
+                updates = list()
+                for _ in range(len(mailbox)):
+                    posted, message = mailbox.popleft()
+                    self.metrics.mailbox_wait.observe(
+                        time.perf_counter() - posted )
+                    if isinstance(message, self.StudentUpdate):
+                        updates.append(message)
+                        continue
+                    work, future = message
+                    try:
+                        result = await work(queue_state)
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as error:
+                        if not future.done():
+                            future.set_exception(error)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                if updates:
+                    await self.drain_updates(queue_state, updates)
+        finally:
+            for _, message in mailbox:
+                future = message.future \
+                    if isinstance(message, self.StudentUpdate) else message[1]
+                future.cancel()
+            queue_state.mailbox = queue_state.drain = None
+            self.busy_students.discard(queue_state)
+
+    @measured
+    async def drain_updates(self, queue_state, updates):
+        # the pending update of the student is merged in as well
+        update = updates[-1]
+        allow_finish = any(update.allow_finish for update in updates)
+        passed_active = any(update.passed_active for update in updates)
+        snapshots = next( ( update.snapshots for update in reversed(updates)
+            if update.snapshots is not None ), None )
+        pending = self.pending_updates.pop(
+            (queue_state.guild_id, queue_state.member_id), None )
+        if pending is not None:
+            if pending.timer is not None:
+                pending.timer.cancel()
+            allow_finish |= pending.allow_finish
+            passed_active |= pending.passed_active
+        try:
+            await self.update_student_in_turn( queue_state, update.member,
+                allow_finish=allow_finish, passed_active=passed_active,
+                snapshots=snapshots )
+        except asyncio.CancelledError:
+            for update in updates:
+                update.future.cancel()
+            raise
+        except Exception as error:
+            for update in updates:
+                if not update.future.done():
+                    update.future.set_exception(error)
+        else:
+            for update in updates:
+                if not update.future.done():
+                    update.future.set_result(None)
+
+    def guild_lock(self, guild_id):
+        # Serializes whole-server operations (reconsidering, dropping)
+        # of one server; events of students do not need it.
+        try:
+            return self.guild_locks[guild_id]
+        except KeyError:
+            lock = self.guild_locks[guild_id] = self.metrics.lock("guild")
+            return lock
+
+    def schedule_clean(self, queue_state):
+        self.expiry.schedule(
+            ("state", queue_state.guild_id, queue_state.member_id),
+            queue_state.mtime + TIME_LIMIT_CLEAN + TIME_EPSILON )
+
+    def queue_state_updated(self, queue_state, *, touch=True):
+        if touch:
+            queue_state.update()
+        self.state_store.note_state(queue_state)
+        self.queue_index.sync(queue_state)
+
+    class QueueIndex:
+        # For every queue channel, the messages that are waiting there
+        # (the current messages of their authors, not finished yet),
+        # as a list of (message_id, member_id) sorted by message id.
+        # Also the author of every current message, finished or not.
+
+        def __init__(self):
+            self.channels = dict()
+            self.entries = dict()
+            self.owners = dict()
+
+        def queue(self, channel_id):
+            return self.channels.get(channel_id, ())
+
+        def owner(self, message_id):
+            return self.owners.get(message_id)
+
+        def sync(self, queue_state):
+            member_id = queue_state.member_id
+            key = queue_state.guild_id, member_id
+            old_entries = self.entries.pop(key, ())
+            new_entries = tuple(queue_state.messages())
+            if new_entries:
+                self.entries[key] = new_entries
+            if new_entries == old_entries:
                 return
-            del guild_states[member_id]
-            if not guild_states:
-                del self.queue_states[guild_id]
-        await self.vandalize_queue_state( guild_id, member_id,
-            queue_state )
+            old_waiting = { channel_id: message_id
+                for channel_id, message_id, finished in old_entries
+                if not finished }
+            new_waiting = { channel_id: message_id
+                for channel_id, message_id, finished in new_entries
+                if not finished }
+            for channel_id, message_id in old_waiting.items():
+                if new_waiting.get(channel_id) != message_id:
+                    self.remove(channel_id, message_id, member_id)
+            for channel_id, message_id in new_waiting.items():
+                if old_waiting.get(channel_id) != message_id:
+                    bisect.insort( self.channels.setdefault(channel_id, []),
+                        (message_id, member_id) )
+            for _, message_id, _ in old_entries:
+                self.owners.pop(message_id, None)
+            for _, message_id, _ in new_entries:
+                self.owners[message_id] = member_id
 
-    async def vandalize_queue_state(self, guild_id, member_id, queue_state):
-        async with queue_state.lock:
-            guild = self.get_guild(guild_id)
-            if guild is None:
+        def remove(self, channel_id, message_id, member_id):
+            channel_queue = self.channels.get(channel_id)
+            if channel_queue is None:
                 return
-            member = guild.get_member(member_id)
-            if member is None:
+            entry = message_id, member_id
+            index = bisect.bisect_left(channel_queue, entry)
+            if index < len(channel_queue) and channel_queue[index] == entry:
+                del channel_queue[index]
+            if not channel_queue:
+                del self.channels[channel_id]
+
+        def forget(self, guild_id, member_id):
+            for channel_id, message_id, finished in \
+                    self.entries.pop((guild_id, member_id), ()):
+                self.owners.pop(message_id, None)
+                if not finished:
+                    self.remove(channel_id, message_id, member_id)
+
+    class ExpiryScheduler:
+        # One timer for all expiry deadlines, kept in a heap.
+        # Rescheduling a key pushes a new entry; the stale entries are
+        # skipped when they come up.  Keys are passed to the callback
+        # when their deadline is reached.
+
+        def __init__(self, callback):
+            self.callback = callback
+            self.heap = list()
+            self.deadlines = dict()
+            self.counter = itertools.count()
+            self.timer = None
+            self.timer_deadline = None
+
+        def schedule(self, key, deadline):
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), key))
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.compact()
+            self.arm()
+
+        def cancel(self, key):
+            self.deadlines.pop(key, None)
+
+        def compact(self):
+            self.heap = [ (deadline, next(self.counter), key)
+                for key, deadline in self.deadlines.items() ]
+            heapq.heapify(self.heap)
+
+        def arm(self):
+            if not self.heap:
                 return
-            for channel_id, message_id in queue_state.messages.items():
-                channel = guild.get_channel(channel_id)
-                if channel is None:
+            deadline = self.heap[0][0]
+            if self.timer is not None:
+                if self.timer_deadline <= deadline:
+                    return
+                self.timer.cancel()
+            self.timer = asyncio.get_running_loop().call_later(
+                max(0, deadline - time.monotonic()), self.expire )
+            self.timer_deadline = deadline
+
+        def expire(self):
+            self.timer = self.timer_deadline = None
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) != deadline:
                     continue
+                del self.deadlines[key]
                 try:
-                    message = await channel.fetch_message(message_id)
-                except (discord.NotFound, discord.Forbidden):
-                    continue
-                await self.message_add_reactions(message, {EMOJI_IGNORED})
-            queue_state.messages.clear()
-            queue_state.finished.clear()
+                    self.callback(key)
+                except Exception:
+                    _LOGGER.exception( f"Exception while expiring {key}",
+                        exc_info=True )
+            self.arm()
 
-    class StudentActivity(dict):
+    def expire(self, key):
+        if key[0] == "state":
+            _, guild_id, member_id = key
+            self.expire_queue_state(guild_id, member_id)
+        elif key[0] == "guild":
+            _, guild = key
+            self.guild_activity(guild).expire_guild(guild)
 
-        def __init__(self):
-            self.awaken = asyncio.Event()
-            self.wake_task = None
-            self.wake_time = None
+    def expire_queue_state(self, guild_id, member_id):
+        guild_states = self.queue_states.get(guild_id)
+        if guild_states is None:
+            return
+        queue_state = guild_states.get(member_id)
+        if queue_state is None:
+            return
+        if queue_state.mtime + TIME_LIMIT_CLEAN > time.monotonic():
+            # updated since it was scheduled
+            self.schedule_clean(queue_state)
+            return
+        del guild_states[member_id]
+        if not guild_states:
+            del self.queue_states[guild_id]
+        self.state_store.forget_state(guild_id, member_id)
+        self.queue_index.forget(guild_id, member_id)
+        asyncio.get_running_loop().create_task(
+            self.ask_student(queue_state, self.vandalize_queue_state) )
+
+    async def vandalize_queue_state(self, queue_state):
+        guild = self.get_guild(queue_state.guild_id)
+        if guild is None:
+            return
+        member = await self.get_member(guild, queue_state.member_id)
+        if member is None:
+            return
+        for channel_id, message_id, _ in queue_state.messages():
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                continue
+            try:
+                message = await self.message_cache.fetch(
+                    channel, message_id )
+            except (discord.NotFound, discord.Forbidden):
+                continue
+            await self.message_add_reactions(message, {EMOJI_IGNORED})
+        queue_state.clear()
 
-        def start_monitor(self):
-            asyncio.get_running_loop().create_task(self.monitor())
+    class StudentActivity(dict):
 
-        async def monitor(self):
-            while True:
-                await self.awaken.wait()
-                self.awaken.clear()
-                self.wake_task = self.wake_time = None
-                now = time.monotonic()
-                gone_inactive = set()
-                deltas = list()
-                for guild, atime in self.items():
-                    delta = atime + TIME_LIMIT_ACTIVE - now
-                    if delta <= 0:
-                        gone_inactive.add(guild)
-                    else:
-                        deltas.append(delta)
-                for guild in gone_inactive:
-                    del self[guild]
-                    self.report_inactive(guild)
-                if deltas:
-                    self.delay_wake(duration=min(deltas) + TIME_EPSILON)
-                else:
-                    self.report_silence()
+        def __init__(self, store, expiry, shard_id=None):
+            self.store = store
+            self.expiry = expiry
+            self.shard_id = shard_id
 
         def report_silence(self):
+            if self.shard_id is not None:
+                _LOGGER.info(
+                    f"All servers of shard {self.shard_id} have gone inactive" )
+                return
             _LOGGER.info(
                 f"All servers have gone inactive" )
 
@@ -243,217 +713,1471 @@ class QueueBot(discord.Client):
             if fresh:
                 self.report_active(guild)
             self[guild] = now
+            self.store.note_guild(guild.id, now)
             if fresh:
-                self.delay_wake( now=now,
-                    duration=TIME_LIMIT_ACTIVE + TIME_EPSILON )
+                self.schedule_expiry(guild)
+
+        def schedule_expiry(self, guild):
+            self.expiry.schedule( ("guild", guild),
+                self[guild] + TIME_LIMIT_ACTIVE + TIME_EPSILON )
+
+        def expire_guild(self, guild):
+            if guild not in self:
+                return
+            if self[guild] + TIME_LIMIT_ACTIVE > time.monotonic():
+                # noted since it was scheduled
+                self.schedule_expiry(guild)
+                return
+            del self[guild]
+            self.report_inactive(guild)
+            if not self:
+                self.report_silence()
 
         def clear_guild(self, guild):
             if guild in self:
                 del self[guild]
+                self.expiry.cancel(("guild", guild))
                 self.report_inactive(guild)
 
-        def delay_wake(self, *, now=None, duration):
-            if now is None:
+    class StateStore:
+        # Queue states and server activity, persisted to an SQLite file.
+        # Changes are collected in memory and written out in batches
+        # (from a worker thread) every STATE_FLUSH_INTERVAL seconds.
+
+        SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queue_state (
+            guild_id INTEGER NOT NULL,
+            member_id INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            status TEXT,
+            PRIMARY KEY (guild_id, member_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS queue_message (
+            guild_id INTEGER NOT NULL,
+            member_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            finished INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, member_id, channel_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS guild_activity (
+            guild_id INTEGER PRIMARY KEY,
+            atime REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS channel_mark (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, channel_id)
+        ) WITHOUT ROWID;
+        """
+
+        def __init__(self, path):
+            self.connection = None
+            if path is not None:
+                self.connection = sqlite3.connect( path,
+                    isolation_level=None, check_same_thread=False )
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.executescript(self.SCHEMA)
+                columns = { row[1] for row in self.connection.execute(
+                    "PRAGMA table_info(queue_state)" ) }
+                if "status" not in columns:
+                    # files written before the status was kept
+                    self.connection.execute(
+                        "ALTER TABLE queue_state ADD COLUMN status TEXT" )
+            self.dirty_states = dict()
+            self.dirty_guilds = dict()
+            self.dirty_marks = dict()
+            self.marks = dict()
+            self.flush_lock = asyncio.Lock()
+            self.flush_task = None
+
+        @staticmethod
+        def wall_time(mtime):
+            return time.time() - (time.monotonic() - mtime)
+
+        @staticmethod
+        def monotonic_time(wall_time):
+            return time.monotonic() - (time.time() - wall_time)
+
+        def note_state(self, queue_state):
+            if self.connection is None:
+                return
+            key = queue_state.guild_id, queue_state.member_id
+            self.dirty_states[key] = queue_state
+
+        def forget_state(self, guild_id, member_id):
+            if self.connection is None:
+                return
+            self.dirty_states[guild_id, member_id] = None
+
+        def note_guild(self, guild_id, atime):
+            if self.connection is None:
+                return
+            self.dirty_guilds[guild_id] = atime
+
+        def note_mark(self, guild_id, channel_id, message_id):
+            # the last message of the channel that has been considered
+            key = guild_id, channel_id
+            if self.connection is None:
+                # still good for catching up after a reconnect
+                if self.marks.get(key, 0) < message_id:
+                    self.marks[key] = message_id
+                return
+            if self.dirty_marks.get(key, 0) < message_id:
+                self.dirty_marks[key] = message_id
+
+        def start(self):
+            if self.connection is None:
+                return
+            self.flush_task = asyncio.get_running_loop().create_task(
+                self.flush_periodically() )
+
+        async def flush_periodically(self):
+            while True:
+                await asyncio.sleep(STATE_FLUSH_INTERVAL)
+                try:
+                    await self.flush()
+                except Exception:
+                    _LOGGER.exception( "Exception while saving queue states",
+                        exc_info=True )
+
+        async def flush(self):
+            if self.connection is None:
+                return
+            async with self.flush_lock:
+                if not self.dirty_states and not self.dirty_guilds and \
+                        not self.dirty_marks:
+                    return
+                dirty_states, self.dirty_states = self.dirty_states, dict()
+                dirty_guilds, self.dirty_guilds = self.dirty_guilds, dict()
+                dirty_marks, self.dirty_marks = self.dirty_marks, dict()
+                forgotten = list()
+                states = list()
+                messages = list()
+                for (guild_id, member_id), queue_state \
+                        in dirty_states.items():
+                    forgotten.append((guild_id, member_id))
+                    if queue_state is None:
+                        continue
+                    states.append(( guild_id, member_id,
+                        self.wall_time(queue_state.mtime),
+                        queue_state.status ))
+                    for channel_id, message_id, finished in \
+                            queue_state.messages():
+                        messages.append(( guild_id, member_id,
+                            channel_id, message_id, finished ))
+                guilds = [ (guild_id, self.wall_time(atime))
+                    for guild_id, atime in dirty_guilds.items() ]
+                marks = [ (guild_id, channel_id, message_id)
+                    for (guild_id, channel_id), message_id
+                    in dirty_marks.items() ]
+                try:
+                    await self.in_thread( self.write,
+                        forgotten, states, messages, guilds, marks )
+                except BaseException:
+                    # the batch is written with the next one, under
+                    # whatever has been noted since
+                    for key, queue_state in dirty_states.items():
+                        self.dirty_states.setdefault(key, queue_state)
+                    for guild_id, atime in dirty_guilds.items():
+                        self.dirty_guilds.setdefault(guild_id, atime)
+                    for key, message_id in dirty_marks.items():
+                        if self.dirty_marks.get(key, 0) < message_id:
+                            self.dirty_marks[key] = message_id
+                    raise
+
+        async def in_thread(self, function, *args):
+            # Called under flush_lock.  A cancelled caller keeps the lock
+            # until the thread is done with the connection, so that the
+            # next flush or close does not use it at the same time.
+            thread = asyncio.ensure_future(asyncio.to_thread(function, *args))
+            try:
+                return await asyncio.shield(thread)
+            except asyncio.CancelledError:
+                await asyncio.wait({thread})
+                raise
+
+        def write(self, forgotten, states, messages, guilds, marks):
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(
+                    "DELETE FROM queue_state "
+                    "WHERE guild_id = ? AND member_id = ?", forgotten )
+                self.connection.executemany(
+                    "DELETE FROM queue_message "
+                    "WHERE guild_id = ? AND member_id = ?", forgotten )
+                self.connection.executemany(
+                    "INSERT INTO queue_state VALUES (?, ?, ?, ?)", states )
+                self.connection.executemany(
+                    "INSERT INTO queue_message VALUES (?, ?, ?, ?, ?)",
+                    messages )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO guild_activity VALUES (?, ?)",
+                    guilds )
+                self.connection.executemany(
+                    "INSERT INTO channel_mark VALUES (?, ?, ?) "
+                    "ON CONFLICT DO UPDATE SET message_id = "
+                        "max(message_id, excluded.message_id)",
+                    marks )
+
+        async def load_guild(self, guild_id):
+            # return (activity time,
+            #   {member_id: (mtime, messages, finished, status)},
+            #   {channel_id: last considered message_id})
+            if self.connection is None:
+                return None, {}, { channel_id: message_id
+                    for (mark_guild_id, channel_id), message_id
+                    in self.marks.items() if mark_guild_id == guild_id }
+            await self.flush()
+            async with self.flush_lock:
+                atime, rows, marks = await self.in_thread(
+                    self.read_guild, guild_id )
+            states = dict()
+            for member_id, mtime, status, channel_id, message_id, finished \
+                    in rows:
+                if member_id not in states:
+                    states[member_id] = (
+                        self.monotonic_time(mtime), dict(), set(), status )
+                if channel_id is None:
+                    continue
+                _, messages, finished_set, _ = states[member_id]
+                messages[channel_id] = message_id
+                if finished:
+                    finished_set.add(message_id)
+            if atime is not None:
+                atime = self.monotonic_time(atime)
+            return atime, states, dict(marks)
+
+        def read_guild(self, guild_id):
+            expired = time.time() - TIME_LIMIT_CLEAN
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.execute(
+                    "DELETE FROM queue_message "
+                    "WHERE guild_id = ? AND member_id IN ("
+                        "SELECT member_id FROM queue_state "
+                        "WHERE guild_id = ? AND mtime <= ? )",
+                    (guild_id, guild_id, expired) )
+                self.connection.execute(
+                    "DELETE FROM queue_state "
+                    "WHERE guild_id = ? AND mtime <= ?",
+                    (guild_id, expired) )
+            row = self.connection.execute(
+                "SELECT atime FROM guild_activity WHERE guild_id = ?",
+                (guild_id,) ).fetchone()
+            atime = row[0] if row is not None else None
+            rows = self.connection.execute(
+                "SELECT s.member_id, s.mtime, s.status, "
+                    "m.channel_id, m.message_id, m.finished "
+                "FROM queue_state AS s LEFT JOIN queue_message AS m "
+                    "ON m.guild_id = s.guild_id "
+                    "AND m.member_id = s.member_id "
+                "WHERE s.guild_id = ?",
+                (guild_id,) ).fetchall()
+            marks = self.connection.execute(
+                "SELECT channel_id, message_id FROM channel_mark "
+                "WHERE guild_id = ?",
+                (guild_id,) ).fetchall()
+            return atime, rows, marks
+
+        async def close(self):
+            if self.connection is None:
+                return
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+                self.flush_task = None
+            try:
+                # after a flush that is still writing
+                await self.flush()
+            finally:
+                self.connection.close()
+                self.connection = None
+
+    class Reconciliation:
+        # Startup jobs of all servers of a shard share one concurrency
+        # bound, so that
+        # requests are spread over the rate limit buckets of discord.py
+        # instead of piling up in them.
+
+        def __init__(self, concurrency):
+            self.semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(self, description, jobs):
+            jobs = list(jobs)
+            if not jobs:
+                return
+            start = last_report = time.monotonic()
+            done = 0
+            async def run_job(job):
+                nonlocal done, last_report
+                async with self.semaphore:
+                    await job()
+                done += 1
                 now = time.monotonic()
-            wake_time = now + duration
-            if self.wake_task is not None:
-                if self.wake_time <= wake_time:
+                if now - last_report >= RECONCILE_PROGRESS_INTERVAL:
+                    last_report = now
+                    _LOGGER.info(f"{description}: {done}/{len(jobs)} done")
+            results = await asyncio.gather(
+                *(run_job(job) for job in jobs), return_exceptions=True )
+            for result in results:
+                if isinstance(result, Exception):
+                    _LOGGER.error( f"Exception in {description}",
+                        exc_info=result )
+            _LOGGER.info(
+                f"{description}: {len(jobs)} done "
+                f"in {time.monotonic() - start:.1f} s" )
+
+    class Recorder:
+        # Gateway events that the bot handles, appended to a file as JSON
+        # lines [milliseconds since start, event, data] after a header
+        # line.  Events caused by the bot itself (its messages and
+        # reactions, and the echoes of the writes done through `echoed`)
+        # are left out, so that a replaying bot can cause them again.
+        # Every file starts with the bot user and the servers as they
+        # are then.  With a key, ids keep only the relative time of their
+        # timestamp bits, and names, attachments, embeds and message
+        # contents (except for commands) are dropped.  Lines are written
+        # from a worker thread.
+
+        SNOWFLAKE_FIELDS = frozenset({"id", "ids", "roles", "mention_roles"})
+        TIME_FIELDS = frozenset({ "timestamp", "edited_timestamp",
+            "joined_at", "premium_since", "communication_disabled_until",
+            "request_to_speak_timestamp" })
+        NAME_FIELDS = frozenset({"username", "global_name", "nick"})
+        BLANK_FIELDS = frozenset({ "avatar", "banner",
+            "avatar_decoration_data" })
+        # lists that are emptied
+        DROPPED_FIELDS = frozenset({"attachments", "embeds"})
+        COMMANDS = frozenset({ "команды", "правила", "алгоритм",
+            "следующий" })
+        MENTION = re.compile(r"<@([!&]?)(\d+)>")
+
+        class GuildSnapshot:
+            # a recorded GUILD_CREATE, kept up to date with the events
+            # after it, so that every file can start with the servers
+
+            def __init__(self, data):
+                self.data = data
+                self.channels = { channel["id"]: channel
+                    for channel in data.get("channels", ()) }
+                self.roles = { role["id"]: role
+                    for role in data.get("roles", ()) }
+                self.members = { member["user"]["id"]: member
+                    for member in data.get("members", ()) }
+                self.voice_states = { voice["user_id"]: voice
+                    for voice in data.get("voice_states", ()) }
+
+            def follow(self, event, data):
+                if event in {"CHANNEL_CREATE", "CHANNEL_UPDATE"}:
+                    self.channels[data["id"]] = data
+                elif event == "CHANNEL_DELETE":
+                    self.channels.pop(data["id"], None)
+                elif event in {"GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE"}:
+                    self.roles[data["role"]["id"]] = data["role"]
+                elif event == "GUILD_ROLE_DELETE":
+                    self.roles.pop(data["role_id"], None)
+                elif event in {"GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE"}:
+                    member = self.members.setdefault(data["user"]["id"], {})
+                    member.update( (key, value)
+                        for key, value in data.items() if key != "guild_id" )
+                elif event == "GUILD_MEMBER_REMOVE":
+                    self.members.pop(data["user"]["id"], None)
+                elif event == "VOICE_STATE_UPDATE":
+                    if data.get("channel_id") is None:
+                        self.voice_states.pop(data["user_id"], None)
+                    else:
+                        self.voice_states[data["user_id"]] = { key: value
+                            for key, value in data.items()
+                            if key not in {"guild_id", "member"} }
+                    if "member" in data:
+                        self.follow("GUILD_MEMBER_UPDATE", data["member"])
+
+            def payload(self):
+                return { **self.data,
+                    "channels": list(self.channels.values()),
+                    "roles": list(self.roles.values()),
+                    "members": list(self.members.values()),
+                    "voice_states": list(self.voice_states.values()) }
+
+        def __init__(self, path, *, key=None):
+            self.path = path
+            self.key = key.encode() if key is not None else None
+            self.time_shift = 0
+            if self.key is not None:
+                # somewhere in the future, 1000 to 5000 days from now
+                days = 1000 + int.from_bytes(
+                    self.digest(b"time")[:2], "big" ) % 4000
+                self.time_shift = days * 24 * 60 * 60 * 1000
+            self.bot_id = None
+            self.start_time = None
+            self.header = None
+            # None among the lines starts a new file
+            self.lines = list()
+            # of the current file, with the lines not written yet
+            self.size = 0
+            self.ready = None
+            self.guilds = dict()  # guild id -> GuildSnapshot
+            self.file = None
+            self.flush_task = None
+            # (event, ids as strings) -> count of writes to be echoed
+            self.echoes = Counter()
+
+        def digest(self, value):
+            return hmac.new(self.key, value, "sha256").digest()
+
+        def start(self):
+            if self.path is None:
+                return
+            self.start_time = time.monotonic()
+            start = discord.utils.time_snowflake(discord.utils.utcnow()) >> 22
+            self.header = json.dumps( { "version": 1,
+                "start": start + self.time_shift,
+                "anonymized": self.key is not None },
+                separators=(",", ":") ) + "\n"
+            if os.path.exists(self.path):
+                self.size = os.path.getsize(self.path)
+            self.append(self.header)
+            self.flush_task = asyncio.get_running_loop().create_task(
+                self.flush_periodically() )
+
+        def record(self, raw):
+            if self.path is None or not isinstance(raw, str):
+                return
+            payload = json.loads(raw)
+            event = payload.get("t")
+            if event not in RECORDED_EVENTS:
+                return
+            data = payload["d"]
+            echo = False
+            if event == "READY":
+                self.bot_id = data["user"]["id"]
+                data = {"user": data["user"]}
+            elif event == "MESSAGE_CREATE":
+                if data["author"]["id"] == self.bot_id:
+                    return
+            elif event in {"MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE"}:
+                if data["user_id"] == self.bot_id:
+                    self.take_echo( event, data["message_id"],
+                        data["emoji"]["name"] )
+                    return
+            elif event == "MESSAGE_REACTION_REMOVE_EMOJI":
+                if self.take_echo( event, data["message_id"],
+                        data["emoji"]["name"] ):
+                    return
+            elif event == "VOICE_STATE_UPDATE":
+                # an echo still moves the student in the snapshot
+                echo = self.take_echo( event, data.get("guild_id"),
+                    data["user_id"], data.get("channel_id") )
+            elif event == "MESSAGE_DELETE":
+                if self.take_echo(event, data["id"]):
+                    return
+            elif event == "GUILD_CREATE":
+                for key in ( "presences", "emojis", "stickers",
+                        "guild_scheduled_events", "soundboard_sounds" ):
+                    if key in data:
+                        data[key] = []
+                if self.key is not None:
+                    data["name"] = "guild-" + self.digest(
+                        data["id"].encode() )[:4].hex()
+            if self.key is not None:
+                data = self.rewrite( data, self.scramble, self.time_shift,
+                    pseudonym=self.pseudonym )
+            self.follow(event, data)
+            if echo:
+                return
+            self.append(self.line(event, data))
+
+        def line(self, event, data):
+            offset = round((time.monotonic() - self.start_time) * 1000)
+            return json.dumps( [offset, event, data],
+                ensure_ascii=False, separators=(",", ":") ) + "\n"
+
+        def append(self, line):
+            self.lines.append(line)
+            self.size += len(line.encode())
+            if self.size < RECORD_MAX_BYTES:
+                return
+            # a new file, which can be replayed on its own
+            lines = [self.header]
+            if self.ready is not None:
+                lines.append(self.line("READY", self.ready))
+            for guild in self.guilds.values():
+                lines.append(self.line("GUILD_CREATE", guild.payload()))
+            self.lines.append(None)
+            self.lines.extend(lines)
+            self.size = sum(len(line.encode()) for line in lines)
+
+        def follow(self, event, data):
+            if event == "READY":
+                self.ready = data
+            elif event == "GUILD_CREATE":
+                self.guilds[data["id"]] = self.GuildSnapshot(data)
+            elif event == "GUILD_DELETE":
+                if not data.get("unavailable"):
+                    self.guilds.pop(data["id"], None)
+            else:
+                guild = self.guilds.get(data.get("guild_id"))
+                if guild is not None:
+                    guild.follow(event, data)
+
+        async def echoed(self, echo, action):
+            # do a write of the bot, whose gateway event echo
+            # (event, *ids) is not to be recorded
+            if self.path is None:
+                return await action()
+            echo = tuple(map(str, echo))
+            self.echoes[echo] += 1
+            try:
+                return await action()
+            except BaseException:
+                self.take_echo(*echo)
+                raise
+
+        def take_echo(self, *echo):
+            echo = tuple(map(str, echo))
+            count = self.echoes.get(echo, 0)
+            if not count:
+                return False
+            if count > 1:
+                self.echoes[echo] = count - 1
+            else:
+                del self.echoes[echo]
+            return True
+
+        def scramble(self, snowflake):
+            timestamp = (snowflake >> 22) + self.time_shift
+            low_bits = int.from_bytes(
+                self.digest(str(snowflake).encode())[:3], "big" ) & 0x3FFFFF
+            return timestamp << 22 | low_bits
+
+        def pseudonym(self, name):
+            return "user-" + self.digest(name.encode())[:4].hex()
+
+        @classmethod
+        def rewrite( cls, data, snowflake, time_shift, *,
+            pseudonym=None, field=None,
+        ):
+            # Ids are passed through snowflake(), and times are shifted by
+            # time_shift milliseconds.  With pseudonym(), the data is
+            # anonymized as well.
+            anonymize = pseudonym is not None
+            if anonymize and field in cls.BLANK_FIELDS:
+                return None
+            if anonymize and field in cls.DROPPED_FIELDS:
+                return []
+            if isinstance(data, dict):
+                return { key: cls.rewrite( value, snowflake, time_shift,
+                        pseudonym=pseudonym, field=key )
+                    for key, value in data.items() }
+            if isinstance(data, list):
+                return [ cls.rewrite( value, snowflake, time_shift,
+                        pseudonym=pseudonym, field=field )
+                    for value in data ]
+            if field is None or not isinstance(data, str):
+                return data
+            if field in cls.SNOWFLAKE_FIELDS or \
+                    field.endswith(("_id", "_ids")):
+                if data.isdigit():
+                    return str(snowflake(int(data)))
+                return data
+            if field in cls.TIME_FIELDS:
+                return ( datetime.fromisoformat(data) +
+                    timedelta(milliseconds=time_shift) ).isoformat()
+            if field == "content":
+                content = cls.MENTION.sub( lambda match:
+                    f"<@{match[1]}{snowflake(int(match[2]))}>", data )
+                if anonymize:
+                    mention, _, command = content.partition(" ")
+                    if cls.MENTION.fullmatch(mention) and \
+                            command.lower() in cls.COMMANDS:
+                        return content
+                    return ""
+                return content
+            if anonymize and field in cls.NAME_FIELDS:
+                return pseudonym(data)
+            return data
+
+        async def flush_periodically(self):
+            while True:
+                await asyncio.sleep(RECORD_FLUSH_INTERVAL)
+                try:
+                    await self.flush()
+                except Exception:
+                    _LOGGER.exception( "Exception while writing recording",
+                        exc_info=True )
+
+        async def flush(self):
+            if not self.lines:
+                return
+            lines = self.lines
+            self.lines = list()
+            await asyncio.to_thread(self.write, lines)
+
+        def write(self, lines):
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            for line in lines:
+                if line is None:
+                    self.rotate()
+                    continue
+                self.file.write(line)
+            self.file.flush()
+
+        def rotate(self):
+            self.file.close()
+            for index in range(RECORD_BACKUP_COUNT - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+            self.file = open(self.path, "a", encoding="utf-8")
+
+        async def close(self):
+            if self.path is None:
+                return
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+                self.flush_task = None
+            await self.flush()
+            if self.file is not None:
+                await asyncio.to_thread(self.file.close)
+                self.file = None
+
+    class Metrics:
+        # Handler durations, lock waits and REST calls, served with the
+        # gauges of the bot in the Prometheus text format.
+
+        class Histogram:
+
+            def __init__(self):
+                self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+                self.sum = 0.0
+
+            def observe(self, value):
+                self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+                self.sum += value
+
+            def lines(self, name, labels):
+                total = 0
+                bucket_labels = labels + "," if labels else ""
+                for bound, count in zip( METRICS_BUCKETS + ("+Inf",),
+                        self.counts ):
+                    total += count
+                    yield ( f"{name}_bucket{{{bucket_labels}"
+                        f'le="{bound}"}} {total}' )
+                if labels:
+                    labels = f"{{{labels}}}"
+                yield f"{name}_sum{labels} {self.sum}"
+                yield f"{name}_count{labels} {total}"
+
+        class TimedLock(asyncio.Lock):
+
+            def __init__(self, histogram):
+                super().__init__()
+                self.histogram = histogram
+
+            async def acquire(self):
+                if not self.locked():
+                    self.histogram.observe(0.0)
+                    return await super().acquire()
+                start = time.perf_counter()
+                try:
+                    return await super().acquire()
+                finally:
+                    self.histogram.observe(time.perf_counter() - start)
+
+        def __init__(self, address):
+            # address is (host, port), or None for no endpoint
+            self.address = address
+            self.handlers = defaultdict(self.Histogram)
+            self.lock_waits = defaultdict(self.Histogram)
+            self.rest_calls = Counter()
+            self.rest_exhausted = Counter()
+            self.rest_limited = Counter()
+            # by (kind, reason)
+            self.events_shed = Counter()
+            self.loop_lag = self.Histogram()
+            # from posting to a student's mailbox to the drain picking up
+            self.mailbox_wait = self.Histogram()
+            self.gauges = None
+            self.runner = None
+
+        def observe_handler(self, name, seconds, stage="run"):
+            self.handlers[name, stage].observe(seconds)
+
+        def lock(self, name):
+            return self.TimedLock(self.lock_waits[name])
+
+        # REST calls are counted by route, with the ids taken out
+        ROUTE_PREFIX = re.compile(r"^/api/v\d+")
+        ROUTE_IDS = re.compile(r"/\d+")
+        ROUTE_EMOJI = re.compile(r"/reactions/[^/]+")
+
+        def route(self, path):
+            path = self.ROUTE_PREFIX.sub("", path)
+            path = self.ROUTE_IDS.sub("/{id}", path)
+            return self.ROUTE_EMOJI.sub("/reactions/{emoji}", path)
+
+        def trace_config(self):
+            async def on_request_end(session, context, params):
+                key = params.method, self.route(params.url.path)
+                status = params.response.status
+                self.rest_calls[key + (status,)] += 1
+                if status == 429:
+                    self.rest_limited[key] += 1
+                elif params.response.headers.get(
+                        "X-RateLimit-Remaining" ) == "0":
+                    self.rest_exhausted[key] += 1
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_end.append(on_request_end)
+            return trace_config
+
+        async def start(self, gauges):
+            # gauges() gives (name, help, [(labels, value)]) triples
+            self.gauges = gauges
+            if self.address is None:
+                return
+            app = web.Application()
+            app.router.add_get("/metrics", self.serve)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            host, port = self.address
+            await web.TCPSite(self.runner, host, port).start()
+            _LOGGER.info(f"serving metrics on http://{host}:{port}/metrics")
+
+        async def close(self):
+            if self.runner is not None:
+                await self.runner.cleanup()
+                self.runner = None
+
+        async def serve(self, request):
+            return web.Response( text=self.render(),
+                content_type="text/plain", charset="utf-8",
+                headers={"X-Content-Type-Options": "nosniff"} )
+
+        @staticmethod
+        def labels(**labels):
+            return ",".join( f'{key}="{value}"'
+                for key, value in labels.items() )
+
+        def render(self):
+            lines = list()
+            def header(name, kind, description):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+            header( "queue_bot_handler_seconds", "histogram",
+                "Duration of event handlers: of queueing their work "
+                "(stage dispatch), and of doing it (stage run)." )
+            for (handler, stage), histogram in sorted(self.handlers.items()):
+                lines.extend(histogram.lines( "queue_bot_handler_seconds",
+                    self.labels(handler=handler, stage=stage) ))
+            header( "queue_bot_lock_wait_seconds", "histogram",
+                "Time spent waiting for locks." )
+            for lock, histogram in sorted(self.lock_waits.items()):
+                lines.extend(histogram.lines( "queue_bot_lock_wait_seconds",
+                    self.labels(lock=lock) ))
+            header( "queue_bot_student_mailbox_wait_seconds", "histogram",
+                "Time events wait in the mailbox of a student." )
+            lines.extend(self.mailbox_wait.lines(
+                "queue_bot_student_mailbox_wait_seconds", "" ))
+            header( "queue_bot_loop_lag_seconds", "histogram",
+                "Lateness of the event loop heartbeat." )
+            lines.extend(self.loop_lag.lines( "queue_bot_loop_lag_seconds",
+                "" ))
+            header( "queue_bot_rest_calls_total", "counter",
+                "REST calls to Discord, by route and status." )
+            for (method, route, status), count in \
+                    sorted(self.rest_calls.items()):
+                labels = self.labels(method=method, route=route, status=status)
+                lines.append(f"queue_bot_rest_calls_total{{{labels}}} {count}")
+            for name, counter, description in (
+                ( "queue_bot_rest_rate_limited_total", self.rest_limited,
+                    "REST calls answered with 429." ),
+                ( "queue_bot_rest_bucket_exhausted_total",
+                    self.rest_exhausted,
+                    "REST calls that used up their rate limit bucket." ),
+            ):
+                header(name, "counter", description)
+                for (method, route), count in sorted(counter.items()):
+                    labels = self.labels(method=method, route=route)
+                    lines.append(f"{name}{{{labels}}} {count}")
+            header( "queue_bot_events_shed_total", "counter",
+                "Events dropped from the event queues, by kind and reason." )
+            for (kind, reason), count in sorted(self.events_shed.items()):
+                labels = self.labels(kind=kind, reason=reason)
+                lines.append(f"queue_bot_events_shed_total{{{labels}}} {count}")
+            for name, description, samples in self.gauges():
+                header(name, "gauge", description)
+                for labels, value in samples:
+                    if labels:
+                        name_labels = f"{name}{{{self.labels(**labels)}}}"
+                    else:
+                        name_labels = name
+                    lines.append(f"{name_labels} {value}")
+            return "\n".join(lines) + "\n"
+
+    class Watchdog:
+        # The loop touches a heartbeat every LAG_INTERVAL, and a thread
+        # watches it.  If the loop is late by more than the threshold,
+        # the thread samples the stack of the loop thread until the loop
+        # is back, and appends the stall to the diagnostics file.
+
+        def __init__(self, path, threshold, histogram):
+            self.path = path
+            self.threshold = threshold
+            self.histogram = histogram
+            self.beat = None
+            self.loop_thread = None
+            self.task = None
+            self.thread = None
+            self.stopped = threading.Event()
+
+        def start(self):
+            if self.path is None:
+                return
+            self.loop_thread = threading.get_ident()
+            self.beat = time.monotonic()
+            self.task = asyncio.get_running_loop().create_task(
+                self.heartbeat() )
+            self.thread = threading.Thread( target=self.watch,
+                name="queue-bot watchdog", daemon=True )
+            self.thread.start()
+
+        async def heartbeat(self):
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(LAG_INTERVAL)
+                self.beat = time.monotonic()
+                self.histogram.observe(self.beat - start - LAG_INTERVAL)
+
+        def watch(self):
+            while not self.stopped.wait(LAG_INTERVAL):
+                beat = self.beat
+                lag = time.monotonic() - beat - LAG_INTERVAL
+                if lag < self.threshold:
+                    continue
+                try:
+                    self.profile(beat)
+                except Exception:
+                    _LOGGER.exception( "Exception in the watchdog",
+                        exc_info=True )
+
+        def profile(self, beat):
+            # sample the loop thread until the heartbeat moves
+            stacks = Counter()
+            first_stack = None
+            while self.beat == beat and not self.stopped.is_set():
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is None:
+                    return
+                stack = tuple( (summary.filename, summary.lineno,
+                        summary.name)
+                    for summary in traceback.extract_stack(frame) )
+                del frame
+                if first_stack is None:
+                    first_stack = stack
+                stacks[stack] += 1
+                time.sleep(LAG_SAMPLE_INTERVAL)
+            if first_stack is None:
+                return
+            stall = time.monotonic() - beat - LAG_INTERVAL
+            filename, lineno, name = first_stack[-1]
+            _LOGGER.warning( f"event loop stalled for {stall:.3f} s "
+                f"in {name} ({os.path.basename(filename)}:{lineno}), "
+                f"see {self.path}" )
+            self.report(stall, first_stack, stacks)
+
+        def report(self, stall, first_stack, stacks):
+            total = sum(stacks.values())
+            lines = [ f"=== {datetime.now().isoformat(timespec='seconds')} "
+                f"event loop stalled for {stall:.3f} s "
+                f"({total} samples every {LAG_SAMPLE_INTERVAL} s)",
+                "Stack when the stall was noticed:" ]
+            lines.extend(self.format_stack(first_stack))
+            own = Counter()
+            for stack, count in stacks.items():
+                own[stack[-1]] += count
+            lines.append("Functions the samples were in:")
+            for (filename, lineno, name), count in own.most_common():
+                lines.append( f"  {count:5d} {count / total:6.1%}  "
+                    f"{filename}:{lineno} in {name}" )
+            for stack, count in stacks.most_common(LAG_REPORT_STACKS):
+                lines.append(f"Sampled stack ({count} of {total} samples):")
+                lines.extend(self.format_stack(stack))
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n\n")
+
+        @staticmethod
+        def format_stack(stack):
+            return [ f"  {filename}:{lineno} in {name}"
+                for filename, lineno, name in stack ]
+
+        def close(self):
+            self.stopped.set()
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+
+    def observe_handler(self, name, duration, *, stage="run"):
+        # to the metrics, and to the log if the work is over the budget;
+        # queueing it may take long waiting for room
+        self.metrics.observe_handler(name, duration, stage)
+        if stage == "run" and duration > self.handler_budget:
+            _LOGGER.warning( f"{name} took {duration:.3f} s, "
+                f"over its budget of {self.handler_budget} s" )
+
+    def metrics_gauges(self):
+        yield ( "queue_bot_queue_states", "Tracked queue states.",
+            [ ( {"shard_id": self.shard_of(guild_id), "guild_id": guild_id},
+                    len(guild_states) )
+                for guild_id, guild_states in self.queue_states.items() ] )
+        yield ( "queue_bot_busy_students",
+            "Students with events in their mailbox.",
+            [({}, len(self.busy_students))] )
+        yield ( "queue_bot_tasks", "Pending asyncio tasks.",
+            [({}, len(asyncio.all_tasks()))] )
+        yield ( "queue_bot_pending_updates",
+            "Student updates waiting for their coalescing window.",
+            [({}, len(self.pending_updates))] )
+        yield ( "queue_bot_event_queue_depth",
+            "Events waiting in the event queue of every server.",
+            [ ( {"shard_id": self.shard_of(guild_id), "guild_id": guild_id},
+                    len(guild_queue) )
+                for guild_id, guild_queue in self.inbox.queues.items() ] )
+        yield ( "queue_bot_event_handlers",
+            "Event workers, and handlers waiting for room in a queue.",
+            [ ( {"state": "working"},
+                    sum(map(len, self.inbox.tasks.values())) ),
+                ( {"state": "waiting"},
+                    sum(map(len, self.inbox.waiters.values())) ) ] )
+        yield ( "queue_bot_outbox_writes", "Writes to Discord in the outbox.",
+            [ ( {"state": "queued"},
+                    sum(map(len, self.outbox.queues.values())) ),
+                ({"state": "running"}, len(self.outbox.tasks)) ] )
+        yield ( "queue_bot_expiry_deadlines", "Scheduled expiry deadlines.",
+            [({}, len(self.expiry.deadlines))] )
+        yield ( "queue_bot_cached_messages", "Messages in the cache.",
+            [({}, len(self.message_cache))] )
+
+    class QueueMessage:
+        # snapshot of a queue message, as far as the queue is concerned
+
+        def __init__(self, guild_id, channel_id, message_id, author_id):
+            self.guild_id = guild_id
+            self.channel_id = channel_id
+            self.id = message_id
+            self.author_id = author_id
+            self.reactions = dict()
+            self.own = set()
+            # what a queued write is going to do with our reactions
+            self.wanted = None
+            self.unwanted = None
+            self.generation = 0
+            # whether a write of our reactions is running
+            self.writing = False
+            # cached from before an outage, and not seen since
+            self.stale = False
+
+        @classmethod
+        def from_message(cls, message):
+            snapshot = cls( message.guild.id, message.channel.id,
+                message.id, message.author.id )
+            for reaction in message.reactions:
+                if reaction.emoji not in EMOJI_SPECTRUM:
+                    continue
+                snapshot.reactions[reaction.emoji] = reaction.count
+                if reaction.me:
+                    snapshot.own.add(reaction.emoji)
+            return snapshot
+
+        @property
+        def created_at(self):
+            return discord.utils.snowflake_time(self.id)
+
+        def present(self):
+            return set( emoji
+                for emoji, count in self.reactions.items() if count > 0 )
+
+        def emoji(self):
+            # as they will be once the queued write is done
+            emoji = self.present()
+            if self.wanted is not None:
+                emoji -= self.unwanted
+                emoji |= self.wanted
+            return emoji
+
+        def want(self, emoji_set):
+            # our reactions are to be exactly emoji_set
+            self.wanted = set(emoji_set)
+            self.unwanted = EMOJI_SPECTRUM - emoji_set
+            self.generation += 1
+
+        def want_also(self, emoji):
+            if self.wanted is None:
+                self.wanted = set()
+                self.unwanted = set()
+            self.wanted.add(emoji)
+            self.unwanted.discard(emoji)
+            self.generation += 1
+
+        def pending_write(self):
+            # reactions to add and to clear
+            if self.wanted is None:
+                return set(), set()
+            return self.wanted - self.own, self.unwanted & self.present()
+
+        def shows(self, emoji_set):
+            # whether our reactions are emoji_set, and no other ones are
+            # there, once the queued write is done
+            own = set(self.own)
+            if self.wanted is not None:
+                own -= self.unwanted
+                own |= self.wanted
+            return emoji_set <= own and self.emoji() <= emoji_set
+
+        def written(self, generation):
+            if self.generation == generation:
+                self.wanted = self.unwanted = None
+
+        # Our own reactions are noted both when the write succeeds and
+        # when the gateway echoes it back, whichever comes first.
+
+        def note_add(self, emoji, *, me):
+            if emoji not in EMOJI_SPECTRUM:
+                return
+            if me:
+                if emoji in self.own:
+                    return
+                self.own.add(emoji)
+            self.reactions[emoji] = self.reactions.get(emoji, 0) + 1
+
+        def note_remove(self, emoji, *, me):
+            if emoji not in EMOJI_SPECTRUM:
+                return
+            if me:
+                if emoji not in self.own:
                     return
-                self.wake_task.cancel()
-                self.wake_task = self.wake_time = None
-            self.wake_task = asyncio.get_running_loop().create_task(
-                self.wait_and_wake(duration) )
-            self.wake_time = wake_time
+                self.own.discard(emoji)
+            count = self.reactions.get(emoji, 0) - 1
+            if count > 0:
+                self.reactions[emoji] = count
+            else:
+                self.reactions.pop(emoji, None)
+
+        def note_clear_emoji(self, emoji):
+            self.reactions.pop(emoji, None)
+            self.own.discard(emoji)
+
+        def note_clear(self):
+            self.reactions.clear()
+            self.own.clear()
+
+    class MessageCache(OrderedDict):
+        # (channel_id, message_id) -> QueueMessage, least recently used first
+
+        def __init__(self, size=MESSAGE_CACHE_SIZE):
+            super().__init__()
+            self.size = size
+
+        def get_message(self, channel_id, message_id):
+            key = channel_id, message_id
+            try:
+                message = self[key]
+            except KeyError:
+                return None
+            self.move_to_end(key)
+            return message
+
+        def store(self, message):
+            key = message.channel_id, message.id
+            self[key] = message
+            self.move_to_end(key)
+            while len(self) > self.size:
+                self.popitem(last=False)
+            return message
+
+        def discard(self, channel_id, message_id):
+            self.pop((channel_id, message_id), None)
+
+        async def fetch(self, channel, message_id):
+            message = self.get_message(channel.id, message_id)
+            if message is not None:
+                return message
+            try:
+                message = await channel.fetch_message(message_id)
+            except discord.NotFound:
+                self.discard(channel.id, message_id)
+                raise
+            return self.store(QueueBot.QueueMessage.from_message(message))
+
+    class Classification:
+        # Teacher roles and queue channels of a server, by id.
+        # Recomputed after roles or channels of the server change.
+
+        def __init__(self, guild):
+            self.teacher_roles = frozenset( role.id
+                for role in guild.roles
+                if role.name.lower().startswith(TEACHER_ROLE_PREFIX) )
+            self.text_queue_order = tuple( channel.id
+                for channel in guild.text_channels
+                if self.channel_is_queue(channel, TEXT_QUEUE_PREFIX) )
+            self.text_queues = frozenset(self.text_queue_order)
+            self.voice_queues = frozenset( channel.id
+                for channel in guild.voice_channels + guild.stage_channels
+                if self.channel_is_queue(channel, VOICE_QUEUE_PREFIX) )
 
-        async def wait_and_wake(self, duration):
-            await asyncio.sleep(duration)
-            self.awaken.set()
+        @staticmethod
+        def channel_is_queue(channel, prefix):
+            if channel.name.lower().startswith(prefix):
+                return True
+            category = channel.category
+            if category is not None and \
+                    category.name.lower().startswith(QUEUE_PREFIX):
+                return True
+            return False
+
+    def classification(self, guild):
+        try:
+            return self.classifications[guild.id]
+        except KeyError:
+            classification = self.classifications[guild.id] = \
+                self.Classification(guild)
+            return classification
+
+    def forget_classification(self, guild):
+        self.classifications.pop(guild.id, None)
 
     def member_is_teacher(self, member):
         if not isinstance(member, discord.Member):
             return False
-        return any(
-            role.name.lower().startswith(TEACHER_ROLE_PREFIX)
-            for role in member.roles )
+        return any( member.get_role(role_id) is not None
+            for role_id in self.classification(member.guild).teacher_roles )
 
     def text_channel_is_queue(self, text_channel):
-        if text_channel.name.lower().startswith(TEXT_QUEUE_PREFIX):
-            return True
-        category = text_channel.category
-        if category is not None and \
-                category.name.lower().startswith(QUEUE_PREFIX):
-            return True
-        return False
+        return text_channel.id in \
+            self.classification(text_channel.guild).text_queues
 
     def voice_channel_is_queue(self, voice_channel):
-        if voice_channel.name.lower().startswith(VOICE_QUEUE_PREFIX):
-            return True
-        category = voice_channel.category
-        if category is not None and \
-                category.name.lower().startswith(QUEUE_PREFIX):
-            return True
-        return False
+        return voice_channel.id in \
+            self.classification(voice_channel.guild).voice_queues
 
     def queue_channels(self, guild):
-        for text_channel in guild.text_channels:
-            if self.text_channel_is_queue(text_channel):
+        for channel_id in self.classification(guild).text_queue_order:
+            text_channel = guild.get_channel(channel_id)
+            if text_channel is not None:
                 yield text_channel
 
     async def consider_message( self, message, *,
         guild=None, channel=None, member=None,
-        queue_state=None, lock_acquired=False,
         historical=False,
     ):
         # return whether something has changed
+        if guild is None:
+            guild = self.get_guild(message.guild_id)
+            if guild is None:
+                return False
         if member is None:
-            member = message.author
-            if not isinstance(member, discord.Member):
+            if message.author_id == self.user.id:
                 return False
-            if member == self.user:
+            member = await self.get_member(guild, message.author_id)
+            if member is None:
                 return False
             if self.member_is_teacher(member):
                 return False
         if channel is None:
-            channel = message.channel
+            channel = guild.get_channel(message.channel_id)
             if not isinstance(channel, discord.TextChannel):
                 return False
             if not self.text_channel_is_queue(channel):
                 return False
-        if guild is None:
-            guild = member.guild
-            assert guild == channel.guild
-        if queue_state is None:
-            if lock_acquired:
-                raise RuntimeError("escaping potential deadlock")
-            queue_state = await self.queue_state(guild, member)
-        if not lock_acquired:
-            await queue_state.lock.acquire()
-        try:
-            messages = queue_state.messages
-            finished = queue_state.finished
-            emoji = set( reaction.emoji
-                for reaction in message.reactions
-                if reaction.emoji in EMOJI_SPECTRUM )
-            if EMOJI_IGNORED in emoji:
-                if channel.id in messages and \
-                        messages[channel.id] == message.id:
-                    del messages[channel.id]
-                    finished.discard(message.id)
-                    queue_state.update()
-                    return True
+        queue_state = await self.queue_state(guild, member)
+        return await self.ask_student( queue_state, functools.partial(
+            self.consider_message_in_turn, message,
+            guild=guild, channel=channel, historical=historical ) )
+
+    async def consider_message_in_turn( self, message, queue_state, *,
+        guild, channel, historical=False,
+    ):
+        emoji = message.emoji()
+        old_message_id = queue_state.get(channel.id)
+        if EMOJI_IGNORED in emoji:
+            if old_message_id == message.id:
+                queue_state.remove(channel.id)
+                self.queue_state_updated(queue_state)
+                return True
+            return False
+        if old_message_id is not None:
+            if old_message_id == message.id:
+                if EMOJI_ACTIVE not in emoji:
+                    finished = queue_state.is_finished(message.id)
+                    if EMOJI_FINISHED in emoji:
+                        if not finished:
+                            queue_state.set_finished(message.id)
+                            self.queue_state_updated(queue_state)
+                            self.guild_activity(guild).note_guild(guild)
+                            return True
+                    else:
+                        if finished:
+                            queue_state.set_finished(message.id, False)
+                            self.queue_state_updated(queue_state)
+                            self.guild_activity(guild).note_guild(guild)
+                            return True
                 return False
-            if channel.id in messages:
-                if messages[channel.id] == message.id:
-                    if EMOJI_ACTIVE not in emoji:
-                        if EMOJI_FINISHED in emoji:
-                            if message.id not in finished:
-                                finished.add(message.id)
-                                queue_state.update()
-                                self.student_activity.note_guild(guild)
-                                return True
-                        else:
-                            if message.id in finished:
-                                finished.discard(message.id)
-                                queue_state.update()
-                                self.student_activity.note_guild(guild)
-                                return True
-                    return False
-                old_message_id = messages[channel.id]
-                try:
-                    old_message = await channel.fetch_message(old_message_id)
-                except (discord.NotFound, discord.Forbidden):
-                    old_message = None
-                if old_message is None:
-                    del messages[channel.id]
-                    finished.discard(old_message_id)
-                elif old_message_id in finished:
-                    del messages[channel.id]
-                    finished.discard(old_message_id)
-                    await self.message_ignore(old_message)
-                else:
-                    await self.message_add_reactions(message, {EMOJI_IGNORED})
-                    return False
-            messages[channel.id] = message.id
-            if EMOJI_FINISHED in emoji:
-                finished.add(message.id)
-            queue_state.update()
-            if not historical:
-                self.student_activity.note_guild(guild)
+            try:
+                old_message = await self.message_cache.fetch(
+                    channel, old_message_id )
+            except (discord.NotFound, discord.Forbidden):
+                old_message = None
+            if old_message is None:
+                queue_state.remove(channel.id)
+            elif queue_state.is_finished(old_message_id):
+                queue_state.remove(channel.id)
+                await self.message_ignore(old_message)
             else:
-                self.student_activity.note_guild( guild,
-                    mtime=message.created_at )
-            return True
-        finally:
-            if not lock_acquired:
-                queue_state.lock.release()
+                await self.message_add_reactions(message, {EMOJI_IGNORED})
+                return False
+        queue_state.put( channel.id, message.id,
+            EMOJI_FINISHED in emoji )
+        self.message_cache.store(message)
+        self.queue_state_updated(queue_state)
+        if not historical:
+            self.guild_activity(guild).note_guild(guild)
+        else:
+            self.guild_activity(guild).note_guild( guild,
+                mtime=message.created_at )
+        return True
 
     async def update_student( self, member, *,
-        guild=None, voice=None, voice_arg=False, allow_finish=False,
-        queue_state=None, lock_acquired=False,
+        guild=None, allow_finish=False, passed_active=False,
+        snapshots=None,
     ):
+        # snapshots are messages already at hand, {message_id: QueueMessage}
         if guild is None:
             guild = member.guild
-        if queue_state is None:
-            if lock_acquired:
-                raise RuntimeError("escaping potential deadlock")
-            queue_state = await self.queue_state(guild, member)
-        if not lock_acquired:
-            await queue_state.lock.acquire()
-        try:
-            messages = queue_state.messages
-            finished = queue_state.finished
-            if not voice_arg:
-                voice = member.voice
-            if voice is None or voice.channel is None:
-                status = "astray"
-            elif self.voice_channel_is_queue(voice.channel):
-                status = "normal"
-            else:
-                status = "active"
-            prospective_finished = set()
-            if status == "active":
-                if not finished and allow_finish:
-                    for channel in self.queue_channels(guild):
-                        if channel.id not in messages:
-                            continue
-                        prospective_finished.add(messages[channel.id])
-                        break
-                self.student_activity.note_guild(guild)
-            garbage = list()
-            for channel_id, message_id in messages.items():
-                channel = guild.get_channel(channel_id)
-                if channel is None or not self.text_channel_is_queue(channel):
-                    garbage.append((channel_id, message_id))
-                    continue
+        queue_state = await self.queue_state(guild, member)
+        if asyncio.current_task() is queue_state.drain:
+            await self.update_student_in_turn( queue_state, member,
+                allow_finish=allow_finish, passed_active=passed_active,
+                snapshots=snapshots )
+            return
+        update = self.StudentUpdate( member,
+            allow_finish, passed_active, snapshots )
+        self.post_student(queue_state, update)
+        await update.future
+
+    async def update_student_in_turn( self, queue_state, member, *,
+        allow_finish=False, passed_active=False, snapshots=None,
+    ):
+        guild = member.guild
+        voice = member.voice
+        status = self.voice_status(
+            voice.channel if voice is not None else None )
+        prospective_finished = set()
+        if status == "active" or passed_active:
+            if not queue_state.any_finished() and allow_finish:
+                for channel in self.queue_channels(guild):
+                    message_id = queue_state.get(channel.id)
+                    if message_id is None:
+                        continue
+                    prospective_finished.add(message_id)
+                    break
+            self.guild_activity(guild).note_guild(guild)
+        garbage = list()
+        for channel_id, message_id, finished in queue_state.messages():
+            channel = guild.get_channel(channel_id)
+            if channel is None or not self.text_channel_is_queue(channel):
+                garbage.append(channel_id)
+                continue
+            message = self.message_cache.get_message(
+                channel_id, message_id )
+            if ( message is None or message.stale ) and \
+                    snapshots is not None and message_id in snapshots:
+                message = self.message_cache.store(snapshots[message_id])
+            if message is None:
                 try:
-                    message = await channel.fetch_message(message_id)
+                    message = await self.message_cache.fetch(
+                        channel, message_id )
                 except (discord.NotFound, discord.Forbidden):
-                    garbage.append((channel_id, message_id))
+                    garbage.append(channel_id)
                     continue
-                emoji = set()
-                if message_id in prospective_finished:
-                    finished.add(message_id)
-                if status == "active":
-                    emoji.add(EMOJI_ACTIVE)
-                elif message_id in finished:
-                    emoji.add(EMOJI_FINISHED)
-                elif status == "astray":
-                    emoji.add(EMOJI_ASTRAY)
-                await self.message_add_reactions(message, emoji)
-            for channel_id, message_id in garbage:
-                del messages[channel_id]
-                finished.discard(message_id)
-            queue_state.update()
-        finally:
-            if not lock_acquired:
-                queue_state.lock.release()
+            if message_id in prospective_finished:
+                queue_state.set_finished(message_id)
+                finished = True
+            await self.message_add_reactions( message,
+                self.student_emoji(status, finished) )
+        for channel_id in garbage:
+            queue_state.remove(channel_id)
+        queue_state.status = status
+        self.queue_state_updated(queue_state)
+
+    def voice_status(self, channel):
+        if channel is None:
+            return "astray"
+        if self.voice_channel_is_queue(channel):
+            return "normal"
+        return "active"
+
+    @staticmethod
+    def student_emoji(status, finished):
+        # our reactions on a message of a student
+        if status == "active":
+            return {EMOJI_ACTIVE}
+        if finished:
+            return {EMOJI_FINISHED}
+        if status == "astray":
+            return {EMOJI_ASTRAY}
+        return set()
+
+    def student_unchanged(self, queue_state, status, snapshots):
+        # whether update_student would change nothing, as far as can be
+        # told without asking Discord; messages that are not at hand
+        # are taken to be as we left them
+        if queue_state.status != status:
+            return False
+        for channel_id, message_id, finished in queue_state.messages():
+            message = self.message_cache.get_message(channel_id, message_id)
+            if message is None or message.stale:
+                message = snapshots.get(message_id, message)
+            if message is None:
+                continue
+            if not message.shows(self.student_emoji(status, finished)):
+                return False
+        return True
+
+    # Updates of a student are coalesced: requests coming within
+    # coalesce_window of each other are merged into one update_student,
+    # which then sees the latest voice state.  A burst is cut short
+    # COALESCE_MAX_DELAY after its first request.  The update then goes
+    # to the event queue of the server.
+
+    class PendingUpdate:
+
+        def __init__(self, member, deadline):
+            # discord.py may drop the member from its cache meanwhile
+            self.member = member
+            self.deadline = deadline
+            self.timer = None
+            self.allow_finish = False
+            self.passed_active = False
+
+    async def request_update( self, member, *,
+        allow_finish=False, passed_active=False,
+    ):
+        key = (member.guild.id, member.id)
+        loop = asyncio.get_running_loop()
+        pending = self.pending_updates.get(key)
+        if pending is None:
+            pending = self.pending_updates[key] = self.PendingUpdate(
+                member, loop.time() + COALESCE_MAX_DELAY )
+        elif pending.timer is not None:
+            pending.timer.cancel()
+        pending.member = member
+        pending.allow_finish |= allow_finish
+        pending.passed_active |= passed_active
+        delay = min(self.coalesce_window, pending.deadline - loop.time())
+        pending.timer = loop.call_later( max(0, delay),
+            self.fire_update, key )
+
+    def fire_update(self, key):
+        pending = self.pending_updates.get(key)
+        if pending is None:
+            return
+        pending.timer = None
+        # if shed, the update stays pending until repair_guild
+        self.inbox.put( key[0], self.inbox.UPDATE,
+            functools.partial(self.run_pending_update, key),
+            key=("update", key[1]) )
+
+    def repair_guild(self, guild_id):
+        # The event queue of the server has drained after shedding:
+        # missed messages are read from the history, and shed reactions
+        # and updates are queued again.  What does not fit waits for
+        # the next time.
+        missed = self.missed_messages.get(guild_id, {})
+        for channel_id, message_id in list(missed.items()):
+            if self.inbox.full(guild_id):
+                self.inbox.defer(guild_id)
+                return
+            del missed[channel_id]
+            self.inbox.put( guild_id, self.inbox.MESSAGE,
+                functools.partial( self.catch_up_missed,
+                    guild_id, channel_id, message_id ) )
+        self.missed_messages.pop(guild_id, None)
+        reactions = self.missed_reactions.get(guild_id, {})
+        for message_id, action in list(reactions.items()):
+            if self.inbox.full(guild_id):
+                self.inbox.defer(guild_id)
+                return
+            del reactions[message_id]
+            self.inbox.put( guild_id, self.inbox.REACTION, action,
+                key=("reaction", message_id) )
+        self.missed_reactions.pop(guild_id, None)
+        for key, pending in list(self.pending_updates.items()):
+            if key[0] != guild_id or pending.timer is not None:
+                continue
+            if self.inbox.full(guild_id):
+                self.inbox.defer(guild_id)
+                break
+            self.fire_update(key)
+
+    async def run_pending_update(self, key):
+        guild_id, member_id = key
+        guild = self.get_guild(guild_id)
+        member = guild.get_member(member_id) if guild is not None else None
+        pending = self.pending_updates.get(key)
+        if pending is None:
+            # merged into another update of the student meanwhile
+            return
+        if member is None and guild is not None and self.lean_members:
+            member = pending.member
+        if member is None:
+            self.pending_updates.pop(key, None)
+            return
+        try:
+            # the pending flags are taken when the update is done
+            await self.update_student(member, guild=guild)
+        except Exception:
+            _LOGGER.exception(
+                f"Exception while updating {member} (guild “{guild.name}”)",
+                exc_info=True )
+
+    async def flush_update(self, member, queue_state):
+        # do the pending update now, in the student's turn
+        pending = self.pending_updates.pop((member.guild.id, member.id), None)
+        if pending is None:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+        await self.update_student_in_turn( queue_state, member,
+            allow_finish=pending.allow_finish,
+            passed_active=pending.passed_active )
+
+    def drop_pending_updates(self, guild_id=None):
+        for key, pending in list(self.pending_updates.items()):
+            if guild_id is not None and key[0] != guild_id:
+                continue
+            if pending.timer is not None:
+                pending.timer.cancel()
+            del self.pending_updates[key]
+
+    async def on_socket_raw_receive(self, message):
+        self.recorder.record(message)
 
     async def on_ready(self):
         _LOGGER.info(
             f"{self.user} has connected to Discord, "
             f"and manages queues on {len(self.guilds)} servers" )
 
+    async def on_shard_ready(self, shard_id):
+        guilds = sum(1 for guild in self.guilds if guild.shard_id == shard_id)
+        _LOGGER.info(
+            f"Shard {shard_id} of {self.shard_count} is ready, "
+            f"and manages queues on {guilds} servers" )
+
     async def on_guild_available(self, guild):
+        self.forget_classification(guild)
         me = guild.me
         _LOGGER.info(
             f"Server “{guild.name}” (id={guild.id}) is available, and "
@@ -468,27 +2192,206 @@ class QueueBot(discord.Client):
             guild_name = "<unavailable>"
         _LOGGER.info(
             f"Server “{guild_name}” (id={guild.id}) is unavailable" )
-        async with self.dict_lock:
-            if guild.id in self.queue_states:
-                del self.queue_states[guild.id]
-        self.student_activity.clear_guild(guild)
+        # Queue states and cached messages are kept, as the snapshot
+        # of what the students were doing; when the server is back, only
+        # the students who have changed since are updated.  The cached
+        # messages are stale until seen again (see confirm_messages).
+        async with self.guild_lock(guild.id):
+            self.guild_activity(guild).clear_guild(guild)
+            self.drop_pending_updates(guild.id)
+            for queue_state in self.queue_states.get(guild.id, {}).values():
+                for channel_id, message_id, _ in queue_state.messages():
+                    message = self.message_cache.get_message(
+                        channel_id, message_id )
+                    if message is not None:
+                        message.stale = True
+        self.forget_classification(guild)
+
+    async def on_guild_remove(self, guild):
+        self.forget_classification(guild)
+
+    async def on_guild_role_create(self, role):
+        self.forget_classification(role.guild)
+
+    async def on_guild_role_delete(self, role):
+        self.forget_classification(role.guild)
+
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name:
+            self.forget_classification(after.guild)
+
+    async def on_guild_channel_create(self, channel):
+        self.forget_classification(channel.guild)
+
+    async def on_guild_channel_delete(self, channel):
+        self.forget_classification(channel.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name or \
+                before.category_id != after.category_id or \
+                before.position != after.position:
+            self.forget_classification(after.guild)
 
     async def reconsider_guild(self, guild):
-        for channel in self.queue_channels(guild):
-            await self.reconsider_channel(channel, guild=guild)
-        async with self.dict_lock:
-            if guild.id not in self.queue_states:
+        async with self.guild_lock(guild.id):
+            await self.reconsider_guild_locked(guild)
+
+    async def reconsider_guild_locked(self, guild):
+        start = time.monotonic()
+        marks = await self.restore_guild(guild)
+        for channel_id, message_id in \
+                self.missed_messages.pop(guild.id, {}).items():
+            mark = marks.get(channel_id)
+            if mark is not None:
+                marks[channel_id] = min(mark, message_id - 1)
+        # tracked messages that are not cached (restored ones, say),
+        # or stale
+        unconfirmed = self.unconfirmed_messages(guild)
+        # the messages of the history pages, so that students are updated
+        # without fetching their messages again; and, by channel id, the
+        # message after which the pages have covered the history
+        snapshots = dict()
+        reached = dict()
+        queue_channels = list(self.queue_channels(guild))
+        await self.reconciliation(guild).run(
+            f"Channels of server “{guild.name}” (id={guild.id})",
+            ( functools.partial( self.reconsider_channel, channel,
+                    guild=guild, mark=marks.get(channel.id),
+                    snapshots=snapshots, reached=reached )
+                for channel in queue_channels ) )
+        voice_channels = { member_id: channel
+            for channel in (*guild.voice_channels, *guild.stage_channels)
+            for member_id in channel.voice_states }
+        await self.confirm_messages( guild, unconfirmed,
+            snapshots=snapshots, reached=reached,
+            voice_channels=voice_channels )
+        queue_states = [ (member_id, queue_state)
+            for member_id, queue_state
+            in self.queue_states.get(guild.id, {}).items()
+            if not self.student_unchanged( queue_state,
+                self.voice_status(voice_channels.get(member_id)), snapshots ) ]
+        members = await self.load_members( guild,
+            [member_id for member_id, _ in queue_states] )
+        jobs = list()
+        for member_id, queue_state in queue_states:
+            member = members.get(member_id)
+            if member is None:
+                continue
+            jobs.append(functools.partial( self.update_student, member,
+                guild=guild, snapshots=snapshots ))
+        await self.reconciliation(guild).run(
+            f"Students of server “{guild.name}” (id={guild.id})", jobs )
+        _LOGGER.info(
+            f"Server “{guild.name}” (id={guild.id}) reconsidered "
+            f"in {time.monotonic() - start:.1f} s" )
+
+    def unconfirmed_messages(self, guild):
+        # [(channel_id, message_id, member_id)] of the tracked messages
+        # of the server that are not in the message cache, or stale there
+        return [ (channel_id, message_id, queue_state.member_id)
+            for queue_state in self.queue_states.get(guild.id, {}).values()
+            for channel_id, message_id, _ in queue_state.messages()
+            if not self.message_confirmed(channel_id, message_id) ]
+
+    def message_confirmed(self, channel_id, message_id):
+        message = self.message_cache.get_message(channel_id, message_id)
+        return message is not None and not message.stale
+
+    async def confirm_messages( self, guild, unconfirmed, *,
+        snapshots, reached, voice_channels,
+    ):
+        # Unconfirmed messages that the history pages should have shown
+        # have been deleted.  Of the others, older than the pages, only
+        # a batch is fetched: of the students waiting in queue channels
+        # first, who can be moved by «следующий».  The rest are taken to
+        # be as we left them (and stay stale if cached).
+        deleted = 0
+        fetched = list()
+        for channel_id, message_id, member_id in unconfirmed:
+            if message_id in snapshots or \
+                    self.message_confirmed(channel_id, message_id):
+                continue
+            if message_id > reached.get(channel_id, message_id):
+                await self.forget_message(guild.id, channel_id, message_id)
+                deleted += 1
+                continue
+            voice_channel = voice_channels.get(member_id)
+            waiting = voice_channel is not None and \
+                self.voice_channel_is_queue(voice_channel)
+            fetched.append((waiting, channel_id, message_id))
+        # newest first
+        fetched.sort(key=lambda entry: (entry[0], entry[2]), reverse=True)
+        async def fetch(channel_id, message_id):
+            nonlocal deleted
+            channel = guild.get_channel(channel_id)
+            if channel is None:
                 return
-            for member_id, queue_state in self.queue_states[guild.id].items():
-                member = guild.get_member(member_id)
-                await self.update_student( member, guild=guild,
-                    queue_state=queue_state )
+            try:
+                message = await channel.fetch_message(message_id)
+            except discord.NotFound:
+                await self.forget_message(guild.id, channel_id, message_id)
+                deleted += 1
+                return
+            except discord.Forbidden:
+                return
+            snapshots[message_id] = self.message_cache.store(
+                self.QueueMessage.from_message(message) )
+        await self.reconciliation(guild).run(
+            f"Messages of server “{guild.name}” (id={guild.id})",
+            ( functools.partial(fetch, channel_id, message_id)
+                for _, channel_id, message_id
+                in fetched[:RECONSIDER_FETCH_LIMIT] ) )
+        if deleted:
+            _LOGGER.info( f"Forgot {deleted} deleted queue messages "
+                f"on server “{guild.name}” (id={guild.id})" )
+
+    async def restore_guild(self, guild):
+        # return the stored history marks of the queue channels
+        atime, states, marks = await self.state_store.load_guild(guild.id)
+        if atime is not None:
+            age = time.monotonic() - atime
+            self.guild_activity(guild).note_guild( guild,
+                mtime=discord.utils.utcnow() - timedelta(seconds=age) )
+        if not states:
+            return marks
+        guild_states = self.queue_states.get(guild.id, {})
+        for member_id, (mtime, messages, finished, status) \
+                in states.items():
+            if member_id in guild_states:
+                continue
+            queue_state = self.add_queue_state(guild.id, member_id)
+            for channel_id, message_id in messages.items():
+                queue_state.put( channel_id, message_id,
+                    message_id in finished )
+            queue_state.mtime = mtime
+            queue_state.status = status
+            self.schedule_clean(queue_state)
+            self.queue_index.sync(queue_state)
+        _LOGGER.info(
+            f"Restored {len(states)} queue states "
+            f"on server “{guild.name}” (id={guild.id})" )
+        return marks
 
-    async def reconsider_channel(self, channel, *, guild):
+    async def reconsider_channel( self, channel, *,
+        guild, mark=None, snapshots=None, reached=None,
+    ):
+        # With a recent mark only the messages after it are considered;
+        # otherwise the history is scanned back to TIME_LIMIT_CLEAN.
+        if mark is not None:
+            mark_age = discord.utils.utcnow() - \
+                discord.utils.snowflake_time(mark)
+            if mark_age.total_seconds() < HISTORY_MARK_LIMIT:
+                await self.catch_up_channel( channel,
+                    guild=guild, mark=mark, snapshots=snapshots,
+                    reached=reached )
+                return
         try:
             prehistoric = discord.utils.utcnow() - timedelta(TIME_LIMIT_CLEAN)
             prehistoric_limit = 7
-            async for message in channel.history(limit=None):
+            async for message in self.channel_history( channel,
+                guild=guild, limit=None,
+            ):
+                self.state_store.note_mark(guild.id, channel.id, message.id)
                 if EDIT_RULES_ON_STARTUP and message.author == self.user:
                     content = message.content
                     if not content.startswith(QUEUE_RULES_PREFIX):
@@ -496,20 +2399,78 @@ class QueueBot(discord.Client):
                     if content == QUEUE_RULES_PREFIX + "\n" + QUEUE_RULES:
                         continue
                     _LOGGER.info("editing previously posted rules")
-                    await message.edit(
-                        content=QUEUE_RULES_PREFIX + "\n" + QUEUE_RULES )
+                    await self.outbox.submit( self.outbox.REPLY,
+                        ("messages", channel.id),
+                        functools.partial( message.edit,
+                            content=QUEUE_RULES_PREFIX + "\n" + QUEUE_RULES ) )
                     prehistoric_limit = 0
                     continue
                 if message.created_at <= prehistoric:
                     prehistoric_limit -= 1
                     if prehistoric_limit < 0:
+                        if reached is not None:
+                            reached[channel.id] = message.id
                         break
-                await self.consider_message( message,
-                    guild=guild, channel=channel,
-                    historical=True )
+                await self.consider_history_message( message,
+                    guild=guild, channel=channel, snapshots=snapshots )
+            else:
+                if reached is not None:
+                    reached[channel.id] = 0
+        except discord.Forbidden:
+            pass
+
+    async def channel_history(self, channel, *, guild, **kwargs):
+        # With lean_members, the authors of a page of messages are
+        # loaded at once, instead of one by one as they come up.
+        if not self.lean_members:
+            async for message in channel.history(**kwargs):
+                yield message
+            return
+        page = list()
+        async for message in channel.history(**kwargs):
+            page.append(message)
+            if len(page) < HISTORY_PAGE_SIZE:
+                continue
+            await self.load_members( guild,
+                {message.author.id for message in page} )
+            for message in page:
+                yield message
+            page.clear()
+        await self.load_members( guild,
+            {message.author.id for message in page} )
+        for message in page:
+            yield message
+
+    async def consider_history_message( self, message, *,
+        guild, channel, snapshots,
+    ):
+        snapshot = self.QueueMessage.from_message(message)
+        if snapshots is not None:
+            snapshots[snapshot.id] = snapshot
+        if self.queue_index.owner(snapshot.id) is not None:
+            self.message_cache.store(snapshot)
+        await self.consider_message( snapshot,
+            guild=guild, channel=channel,
+            historical=True )
+
+    async def catch_up_channel( self, channel, *,
+        guild, mark, snapshots=None, reached=None,
+    ):
+        try:
+            async for message in self.channel_history( channel,
+                guild=guild, limit=None,
+                after=discord.Object(mark), oldest_first=True,
+            ):
+                if message.author != self.user:
+                    await self.consider_history_message( message,
+                        guild=guild, channel=channel, snapshots=snapshots )
+                self.state_store.note_mark(guild.id, channel.id, message.id)
+            if reached is not None:
+                reached[channel.id] = mark
         except discord.Forbidden:
             pass
 
+    @dispatching
     async def on_message(self, message):
         member = message.author
         channel = message.channel
@@ -517,63 +2478,165 @@ class QueueBot(discord.Client):
             return
         if not isinstance(channel, discord.TextChannel):
             return
-        if self.user in message.mentions:
-            if await self.on_command(message):
-                return
         if self.member_is_teacher(member):
+            if self.user in message.mentions:
+                await self.inbox.submit( channel.guild.id, self.inbox.COMMAND,
+                    functools.partial(self.on_command, message) )
             return
         if not self.text_channel_is_queue(channel):
             return
-        queue_state = await self.queue_state(None, member)
-        async with queue_state.lock:
-            changed = await self.consider_message( message,
-                member=member, channel=channel,
-                queue_state=queue_state, lock_acquired=True )
-            if changed:
-                await self.update_student( member,
-                    queue_state=queue_state, lock_acquired=True )
+        if await self.inbox.submit( channel.guild.id, self.inbox.MESSAGE,
+            functools.partial(self.consider_new_message, message),
+        ) is None:
+            missed = self.missed_messages.setdefault(channel.guild.id, {})
+            missed[channel.id] = min(missed.get(channel.id, message.id),
+                message.id)
+
+    async def catch_up_missed(self, guild_id, channel_id, message_id):
+        # messages shed from the event queue, from message_id on
+        guild = self.get_guild(guild_id)
+        if guild is None:
+            return
+        channel = guild.get_channel(channel_id)
+        if channel is None:
+            return
+        snapshots = dict()
+        await self.catch_up_channel( channel,
+            guild=guild, mark=message_id - 1, snapshots=snapshots )
+        for snapshot in snapshots.values():
+            if self.queue_index.owner(snapshot.id) is None:
+                continue
+            member = await self.student(guild, snapshot.author_id)
+            if member is not None:
+                await self.request_update(member)
+
+    async def consider_new_message(self, message):
+        member = message.author
+        channel = message.channel
+        message = self.QueueMessage.from_message(message)
+        changed = await self.consider_message( message,
+            guild=member.guild, member=member, channel=channel )
+        if changed:
+            await self.request_update(member)
+        self.state_store.note_mark(channel.guild.id, channel.id, message.id)
 
+    @dispatching
     async def on_voice_state_update(self, member, before, after):
+        # only arms the update timer; see drain_updates
         if self.member_is_teacher(member):
             return
         if before.channel == after.channel:
             return
-        await self.update_student(member, voice=after, allow_finish=True)
+        passed_active = ( after.channel is not None and
+            not self.voice_channel_is_queue(after.channel) )
+        await self.request_update( member,
+            allow_finish=True, passed_active=passed_active )
 
-    async def on_raw_reaction_add(self, payload):
-        if payload.user_id == self.user.id:
-            return
-        if payload.guild_id is None:
+    # Reaction events are filtered by what the payload tells: only our
+    # emoji matter, and only on messages of students in queue channels.
+    # Events that leave the emoji of a cached message as they were
+    # cannot change anything either.
+
+    @measured
+    async def on_raw_message_delete(self, payload):
+        await self.forget_message( payload.guild_id, payload.channel_id,
+            payload.message_id )
+
+    @measured
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            await self.forget_message( payload.guild_id, payload.channel_id,
+                message_id )
+
+    async def forget_message(self, guild_id, channel_id, message_id):
+        # a deleted message is no longer fetched, reacted to or queued
+        if guild_id is None:
             return
-        guild = self.get_guild(payload.guild_id)
-        if guild is None:
+        self.message_cache.discard(channel_id, message_id)
+        self.outbox.cancel(("reactions", channel_id, message_id))
+        member_id = self.queue_index.owner(message_id)
+        if member_id is None:
             return
-        channel = guild.get_channel(payload.channel_id)
-        if channel is None or not isinstance(channel, discord.TextChannel):
+        queue_state = self.queue_states.get(guild_id, {}).get(member_id)
+        if queue_state is None:
             return
-        if not self.text_channel_is_queue(channel):
+        async def forget(queue_state):
+            if queue_state.get(channel_id) != message_id:
+                return
+            queue_state.remove(channel_id)
+            self.queue_state_updated(queue_state, touch=False)
+        await self.ask_student(queue_state, forget)
+
+    @dispatching
+    async def on_raw_reaction_add(self, payload):
+        emoji = str(payload.emoji)
+        if emoji not in EMOJI_SPECTRUM:
             return
-        try:
-            message = await channel.fetch_message(payload.message_id)
-        except (discord.NotFound, discord.Forbidden):
+        me = payload.user_id == self.user.id
+        message = self.message_cache.get_message(
+            payload.channel_id, payload.message_id )
+        if message is not None:
+            emoji_before = message.emoji()
+            message.note_add(emoji, me=me)
+            if message.emoji() == emoji_before:
+                return
+        if me:
             return
-        member = message.author
-        if member == self.user:
+        await self.queue_reaction( payload, message,
+            author_id=payload.message_author_id )
+
+    @dispatching
+    async def on_raw_reaction_remove(self, payload):
+        emoji = str(payload.emoji)
+        if emoji not in EMOJI_SPECTRUM:
             return
-        if self.member_is_teacher(member):
+        message = self.message_cache.get_message(
+            payload.channel_id, payload.message_id )
+        if message is not None:
+            emoji_before = message.emoji()
+            message.note_remove(emoji, me=payload.user_id == self.user.id)
+            if message.emoji() == emoji_before:
+                return
+        await self.queue_reaction(payload, message)
+
+    @dispatching
+    async def on_raw_reaction_clear_emoji(self, payload):
+        emoji = str(payload.emoji)
+        if emoji not in EMOJI_SPECTRUM:
             return
-        queue_state = await self.queue_state(guild, member)
-        async with queue_state.lock:
-            changed = await self.consider_message( message,
-                member=member, channel=channel,
-                queue_state=queue_state, lock_acquired=True )
-            if changed:
-                await self.update_student( member,
-                    queue_state=queue_state, lock_acquired=True )
+        message = self.message_cache.get_message(
+            payload.channel_id, payload.message_id )
+        if message is not None:
+            emoji_before = message.emoji()
+            message.note_clear_emoji(emoji)
+            if message.emoji() == emoji_before:
+                return
+        await self.queue_reaction(payload, message)
 
-    async def on_raw_reaction_remove(self, payload):
+    @dispatching
+    async def on_raw_reaction_clear(self, payload):
+        message = self.message_cache.get_message(
+            payload.channel_id, payload.message_id )
+        if message is not None:
+            emoji_before = message.emoji()
+            message.note_clear()
+            if not emoji_before:
+                return
+        await self.queue_reaction(payload, message)
+
+    async def queue_reaction(self, payload, message, *, author_id=None):
+        # a later event on the same message makes this one superfluous
         if payload.guild_id is None:
             return
+        action = functools.partial( self.reconsider_reaction,
+            payload, message, author_id=author_id )
+        if await self.inbox.submit( payload.guild_id, self.inbox.REACTION,
+            action, key=("reaction", payload.message_id),
+        ) is None:
+            self.missed_reactions.setdefault( payload.guild_id, {} )[
+                payload.message_id ] = action
+
+    async def reconsider_reaction(self, payload, message, *, author_id=None):
         guild = self.get_guild(payload.guild_id)
         if guild is None:
             return
@@ -582,59 +2645,407 @@ class QueueBot(discord.Client):
             return
         if not self.text_channel_is_queue(channel):
             return
-        try:
-            message = await channel.fetch_message(payload.message_id)
-        except (discord.NotFound, discord.Forbidden):
-            return
-        member = message.author
-        if member == self.user:
-            return
-        if self.member_is_teacher(member):
-            return
+        if message is not None:
+            author_id = message.author_id
+        if author_id is not None:
+            member = await self.student(guild, author_id)
+            if member is None:
+                return
+        if message is None:
+            try:
+                message = await self.message_cache.fetch(
+                    channel, payload.message_id )
+            except (discord.NotFound, discord.Forbidden):
+                return
+            member = await self.student(guild, message.author_id)
+            if member is None:
+                return
+        async def reconsider(queue_state):
+            # our own reactions on this message may still be pending
+            if queue_state.get(channel.id) == message.id:
+                await self.flush_update(member, queue_state)
+            return await self.consider_message_in_turn( message, queue_state,
+                guild=guild, channel=channel )
         queue_state = await self.queue_state(guild, member)
-        async with queue_state.lock:
-            changed = await self.consider_message( message,
-                member=member, channel=channel,
-                queue_state=queue_state, lock_acquired=True )
-            if changed:
-                await self.update_student( member,
-                    queue_state=queue_state, lock_acquired=True )
+        if await self.ask_student(queue_state, reconsider):
+            await self.request_update(member)
+
+    async def student(self, guild, member_id):
+        # the member, if they are a student
+        if member_id == self.user.id:
+            return None
+        member = await self.get_member(guild, member_id)
+        if member is None or self.member_is_teacher(member):
+            return None
+        return member
+
+    async def get_member(self, guild, member_id):
+        member = guild.get_member(member_id)
+        if member is not None or not self.lean_members:
+            return member
+        return (await self.load_members(guild, [member_id])).get(member_id)
+
+    async def load_members(self, guild, member_ids):
+        # {member_id: member}; with lean_members, the members missing
+        # from the cache are asked for through the gateway, up to
+        # MEMBER_QUERY_SIZE at once, and stay cached until they leave
+        # a voice channel
+        members = dict()
+        missing = list()
+        for member_id in member_ids:
+            member = guild.get_member(member_id)
+            if member is not None:
+                members[member_id] = member
+            elif self.lean_members:
+                missing.append(member_id)
+        for start in range(0, len(missing), MEMBER_QUERY_SIZE):
+            try:
+                for member in await guild.query_members( cache=True,
+                    user_ids=missing[start:start+MEMBER_QUERY_SIZE],
+                    limit=MEMBER_QUERY_SIZE,
+                ):
+                    members[member.id] = member
+            except asyncio.TimeoutError:
+                _LOGGER.warning(
+                    f"Timed out loading members "
+                    f"of server “{guild.name}” (id={guild.id})" )
+        return members
 
-    on_raw_reaction_clear_emoji = on_raw_reaction_remove
-    on_raw_reaction_clear = on_raw_reaction_remove
+    def partial_message(self, message):
+        channel = self.get_channel(message.channel_id)
+        if channel is None:
+            return None
+        return channel.get_partial_message(message.id)
 
     async def message_ignore(self, message):
-        try:
-            await message.add_reaction(EMOJI_IGNORED)
-        except (discord.NotFound, discord.Forbidden):
-            return
+        message.want_also(EMOJI_IGNORED)
+        self.queue_reactions(message)
 
     async def message_add_reactions(self, message, emoji_set):
+        if not emoji_set <= EMOJI_SPECTRUM:
+            unknown_emoji = next(emoji_set - EMOJI_SPECTRUM)
+            raise RuntimeError(
+                f"Unrecognised emoji {unknown_emoji} "
+                f"(code {''.join(hex(ord(e)) for ee in unknown_emoji)})" )
+        message.want(emoji_set)
+        self.queue_reactions(message)
+
+    # Reaction writes are queued, one per message: a write that has not
+    # started yet does whatever is wanted for the message when it starts.
+
+    def queue_reactions(self, message):
+        emoji_add, emoji_remove = message.pending_write()
+        if not emoji_add and not emoji_remove:
+            # a running write does not show in pending_write yet, and
+            # looks at the wish again when it is done
+            if not message.writing:
+                message.written(message.generation)
+            return
+        self.outbox.submit( self.outbox.REACTION,
+            ("reactions", message.channel_id),
+            functools.partial(self.write_reactions, message),
+            key=("reactions", message.channel_id, message.id) )
+
+    async def write_reactions(self, message):
+        # until the wish stops changing under the write
+        message.writing = True
         try:
-            if not emoji_set <= EMOJI_SPECTRUM:
-                unknown_emoji = next(emoji_set - EMOJI_SPECTRUM)
-                raise RuntimeError(
-                    f"Unrecognised emoji {unknown_emoji} "
-                    f"(code {''.join(hex(ord(e)) for ee in unknown_emoji)})" )
-            me = self.user
-            emoji_add = set(emoji_set)
-            reactions_remove = list()
-            for reaction in message.reactions:
-                if reaction.emoji not in EMOJI_SPECTRUM:
-                    continue
-                if reaction.emoji in emoji_set:
-                    async for user in reaction.users():
-                        if user == me:
-                            emoji_add.discard(reaction.emoji)
-                            break
-                else:
-                    reactions_remove.append(reaction)
-            for emoji in emoji_add:
-                await message.add_reaction(emoji)
-            for reaction in reactions_remove:
-                await reaction.clear()
+            partial_message = self.partial_message(message)
+            while partial_message is not None:
+                emoji_add, emoji_remove = message.pending_write()
+                if not emoji_add and not emoji_remove:
+                    break
+                for emoji in emoji_add:
+                    await self.recorder.echoed(
+                        ("MESSAGE_REACTION_ADD", message.id, emoji),
+                        functools.partial(partial_message.add_reaction, emoji) )
+                    message.note_add(emoji, me=True)
+                for emoji in emoji_remove:
+                    await self.recorder.echoed(
+                        ("MESSAGE_REACTION_REMOVE_EMOJI", message.id, emoji),
+                        functools.partial( partial_message.clear_reaction,
+                            emoji ) )
+                    message.note_clear_emoji(emoji)
         except (discord.NotFound, discord.Forbidden):
             return
+        except Exception:
+            _LOGGER.exception( f"Exception while writing reactions "
+                f"to message {message.id}", exc_info=True )
+        finally:
+            message.writing = False
+            message.written(message.generation)
+
+    class Inbox:
+        # Work on the events of every server is queued here, and done by
+        # at most `workers` tasks per server, which only exist while
+        # there is work.  A queued event is replaced by a later one with
+        # the same key.  A queue holds at most `limit` events; beyond
+        # that, commands still get in, student updates are shed (with
+        # the "shed" overflow policy) or let in up to twice the limit
+        # (with "wait"), and other events wait for room.  At most
+        # `limit` events wait so; beyond that, they are shed as well.
+        # Once a queue that has shed events is down to half the limit,
+        # `repair` is called for the server.
+
+        COMMAND = "command"
+        MESSAGE = "message"
+        REACTION = "reaction"
+        UPDATE = "update"
+
+        class Job:
+
+            __slots__ = ("kind", "key", "action")
+
+            def __init__(self, kind, key, action):
+                self.kind = kind
+                self.key = key
+                self.action = action
+
+        def __init__(self, limit, workers, overflow, shed, repair, observe):
+            self.limit = limit
+            self.workers = workers
+            self.overflow = overflow
+            # Counter by (kind, reason)
+            self.shed = shed
+            self.repair = repair
+            # called with the name of the handler and the duration
+            # of every job
+            self.observe = observe
+            self.queues = dict()  # guild_id -> deque of jobs
+            self.keyed = dict()  # (guild_id, key) -> job
+            self.tasks = dict()  # guild_id -> set of tasks
+            self.waiters = dict()  # guild_id -> deque of futures
+            self.damaged = set()
+
+        def put(self, guild_id, kind, action, *, key=None):
+            # return False if the event has to wait for room, and None
+            # if it has been shed
+            if key is not None:
+                job = self.keyed.get((guild_id, key))
+                if job is not None:
+                    job.action = action
+                    self.shed[kind, "superseded"] += 1
+                    return True
+            guild_queue = self.queues.get(guild_id)
+            if guild_queue is None:
+                guild_queue = self.queues[guild_id] = deque()
+            if len(guild_queue) >= self.limit and kind != self.COMMAND:
+                if kind != self.UPDATE:
+                    return False
+                if self.overflow == "shed" or \
+                        len(guild_queue) >= 2 * self.limit:
+                    self.overflow_shed(guild_id, kind)
+                    return None
+            job = self.Job(kind, key, action)
+            guild_queue.append(job)
+            if key is not None:
+                self.keyed[guild_id, key] = job
+            tasks = self.tasks.setdefault(guild_id, set())
+            if len(tasks) < self.workers:
+                tasks.add(asyncio.create_task( self.work(guild_id),
+                    name=f"queue-bot: events {guild_id}" ))
+            return True
+
+        @staticmethod
+        def handler_name(job):
+            handler = getattr(job.action, "func", job.action)
+            return getattr(handler, "__name__", job.kind)
+
+        def full(self, guild_id):
+            return len(self.queues.get(guild_id, ())) >= self.limit
+
+        def defer(self, guild_id):
+            # call repair once the queue of the server drains
+            self.damaged.add(guild_id)
+
+        def overflow_shed(self, guild_id, kind):
+            self.shed[kind, "overflow"] += 1
+            if guild_id not in self.damaged:
+                _LOGGER.warning( f"Event queue of server "
+                    f"id={guild_id} is full, shedding events" )
+            self.defer(guild_id)
+
+        async def submit(self, guild_id, kind, action, *, key=None):
+            # return None if the event has been shed
+            while True:
+                result = self.put(guild_id, kind, action, key=key)
+                if result is not False:
+                    return result
+                waiters = self.waiters.setdefault(guild_id, deque())
+                if len(waiters) >= self.limit:
+                    self.overflow_shed(guild_id, kind)
+                    return None
+                waiter = asyncio.get_running_loop().create_future()
+                waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                    raise
+
+        def wake(self, guild_id):
+            waiters = self.waiters.get(guild_id)
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+            if not waiters:
+                self.waiters.pop(guild_id, None)
+
+        async def work(self, guild_id):
+            guild_queue = self.queues[guild_id]
+            try:
+                while guild_queue:
+                    job = guild_queue.popleft()
+                    if job.key is not None:
+                        del self.keyed[guild_id, job.key]
+                    self.wake(guild_id)
+                    if guild_id in self.damaged and \
+                            len(guild_queue) <= self.limit // 2:
+                        self.damaged.discard(guild_id)
+                        self.repair(guild_id)
+                    start = time.perf_counter()
+                    try:
+                        await job.action()
+                    except Exception:
+                        _LOGGER.exception( f"Exception in {job.kind} event "
+                            f"of server id={guild_id}", exc_info=True )
+                    finally:
+                        self.observe( self.handler_name(job),
+                            time.perf_counter() - start )
+            finally:
+                tasks = self.tasks.get(guild_id)
+                if tasks is not None:
+                    tasks.discard(asyncio.current_task())
+                    if not tasks:
+                        del self.tasks[guild_id]
+                        if not guild_queue:
+                            del self.queues[guild_id]
+                            if guild_id in self.damaged:
+                                self.damaged.discard(guild_id)
+                                self.repair(guild_id)
+
+        def close(self):
+            for tasks in self.tasks.values():
+                for task in tasks:
+                    task.cancel()
+            for waiters in self.waiters.values():
+                for waiter in waiters:
+                    waiter.cancel()
+            self.tasks.clear()
+            self.waiters.clear()
+            self.queues.clear()
+            self.keyed.clear()
+            self.damaged.clear()
+
+    class Outbox:
+        # Writes to Discord, most urgent first.  Only one write per
+        # rate-limit bucket is in flight at a time; the rest wait here,
+        # where a keyed write can still be merged with a later one (whose
+        # action is then done instead).
+
+        MOVE = 0
+        REPLY = 1
+        REACTION = 2
+
+        class Job:
+
+            def __init__(self, priority, bucket, key, action):
+                self.priority = priority
+                self.bucket = bucket
+                self.key = key
+                self.action = action
+                self.future = asyncio.get_running_loop().create_future()
+
+        def __init__(self, concurrency):
+            self.concurrency = concurrency
+            self.queues = dict()  # bucket -> heap of (priority, seq, job)
+            self.ready = list()  # heap of (priority, seq, bucket)
+            self.busy = set()
+            self.keyed = dict()
+            self.tasks = set()
+            self.counter = itertools.count()
+
+        def submit(self, priority, bucket, action, *, key=None):
+            # the future of the action's result
+            if key is not None and key in self.keyed:
+                job = self.keyed[key]
+                job.action = action
+                return job.future
+            job = self.Job(priority, bucket, key, action)
+            if key is not None:
+                self.keyed[key] = job
+            entry = (priority, next(self.counter), job)
+            bucket_queue = self.queues.setdefault(bucket, list())
+            heapq.heappush(bucket_queue, entry)
+            if bucket not in self.busy and bucket_queue[0] is entry:
+                heapq.heappush(self.ready, (priority, entry[1], bucket))
+            self.pump()
+            return job.future
+
+        def pump(self):
+            while self.ready and len(self.tasks) < self.concurrency:
+                _, seq, bucket = heapq.heappop(self.ready)
+                bucket_queue = self.queues.get(bucket)
+                if bucket in self.busy or not bucket_queue or \
+                        bucket_queue[0][1] != seq:
+                    continue
+                _, _, job = heapq.heappop(bucket_queue)
+                if not bucket_queue:
+                    del self.queues[bucket]
+                if job.action is None:
+                    # cancelled
+                    if bucket_queue:
+                        priority, seq, _ = bucket_queue[0]
+                        heapq.heappush(self.ready, (priority, seq, bucket))
+                    continue
+                if job.key is not None:
+                    del self.keyed[job.key]
+                self.busy.add(bucket)
+                self.tasks.add(asyncio.create_task( self.run(job),
+                    name=f"queue-bot: write {bucket}" ))
+
+        async def run(self, job):
+            try:
+                result = await job.action()
+            except Exception as error:
+                if not job.future.done():
+                    job.future.set_exception(error)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.tasks.discard(asyncio.current_task())
+                self.busy.discard(job.bucket)
+                bucket_queue = self.queues.get(job.bucket)
+                if bucket_queue:
+                    priority, seq, _ = bucket_queue[0]
+                    heapq.heappush(self.ready, (priority, seq, job.bucket))
+                self.pump()
+
+        def cancel(self, key):
+            # drop a keyed write that has not started yet
+            job = self.keyed.pop(key, None)
+            if job is not None:
+                job.action = None
+                job.future.cancel()
+
+        def close(self):
+            for task in self.tasks:
+                task.cancel()
+            for bucket_queue in self.queues.values():
+                for _, _, job in bucket_queue:
+                    job.future.cancel()
+            self.queues.clear()
+            self.ready.clear()
+            self.keyed.clear()
+
+    async def send(self, channel, content, **kwargs):
+        return await self.outbox.submit( self.outbox.REPLY,
+            ("messages", channel.id),
+            functools.partial(channel.send, content, **kwargs) )
 
     async def on_command(self, message):
         # return whether it really should be considered a command
@@ -659,7 +3070,7 @@ class QueueBot(discord.Client):
             await self.on_command_algorithm(channel)
         elif command.lower() == "следующий":
             if not self.text_channel_is_queue(channel):
-                await channel.send( f"<@!{message.author.id}> "
+                await self.send( channel, f"<@!{message.author.id}> "
                     "Команду «следующий» можно запускать "
                     "только в чате очереди.",
                     allowed_mentions=discord.AllowedMentions(
@@ -668,7 +3079,13 @@ class QueueBot(discord.Client):
                 )
                 return True
             await self.on_command_next(channel, message.author)
-            await message.delete()
+            try:
+                await self.outbox.submit( self.outbox.REPLY,
+                    ("messages", channel.id), functools.partial(
+                        self.recorder.echoed,
+                        ("MESSAGE_DELETE", message.id), message.delete ) )
+            except discord.NotFound:
+                pass
         else:
             await self.send_help( channel,
                 reply_to=message.author,
@@ -678,47 +3095,64 @@ class QueueBot(discord.Client):
     async def on_command_rules(self, channel, *, is_queue=False):
         #nick = channel.guild.me.nick
         prefix = QUEUE_RULES_PREFIX if is_queue else QUEUE_RULES_PREFIX_OTHER
-        await channel.send( prefix + "\n" + QUEUE_RULES,
+        await self.send( channel, prefix + "\n" + QUEUE_RULES,
             allowed_mentions=discord.AllowedMentions(
                 everyone=False, roles=False, users=False )
         )
 
     async def on_command_algorithm(self, channel):
-        await channel.send( QUEUE_ALGORITHM,
+        await self.send( channel, QUEUE_ALGORITHM,
             allowed_mentions=discord.AllowedMentions(
                 everyone=False, roles=False, users=False )
         )
 
+    @measured
     async def on_command_next(self, channel, teacher):
         guild = channel.guild
-        async for message in channel.history(oldest_first=True):
-            member = message.author
-            if not isinstance(member, discord.Member):
-                continue
-            if member == self.user:
+        guild_states = self.queue_states.get(guild.id, {})
+        for message_id, member_id in list(self.queue_index.queue(channel.id)):
+            member = await self.get_member(guild, member_id)
+            if member is None:
                 continue
             if self.member_is_teacher(member):
                 continue
-            queue_state = await self.queue_state(guild, member)
-            if channel.id not in queue_state.messages:
+            queue_state = guild_states.get(member_id)
+            if queue_state is None:
                 continue
-            if queue_state.messages[channel.id] != message.id:
+            if queue_state.get(channel.id) != message_id:
                 continue
-            if message.id in queue_state.finished:
+            if queue_state.is_finished(message_id):
                 continue
             if member.voice is None or member.voice.channel is None:
                 return
+            # the index may be older than the message (restored, or kept
+            # through an outage); a deleted one is not anybody's turn
+            if not self.message_confirmed(channel.id, message_id):
+                self.message_cache.discard(channel.id, message_id)
+            try:
+                await self.message_cache.fetch(channel, message_id)
+            except discord.NotFound:
+                await self.forget_message(guild.id, channel.id, message_id)
+                continue
             break
         else:
             return
-        async with queue_state.lock:
+        async def move(queue_state):
             if teacher.voice is None or teacher.voice.channel is None:
                 return
             voice_channel = teacher.voice.channel
             if self.voice_channel_is_queue(voice_channel):
                 return
-            await member.move_to(voice_channel, reason="queue")
-            queue_state.finished.add(message.id)
+            await self.outbox.submit( self.outbox.MOVE,
+                ("members", guild.id),
+                functools.partial( self.recorder.echoed,
+                    ( "VOICE_STATE_UPDATE",
+                        guild.id, member.id, voice_channel.id ),
+                    functools.partial( member.move_to, voice_channel,
+                        reason="queue" ) ) )
+            queue_state.set_finished(message_id)
+            self.queue_state_updated(queue_state, touch=False)
+        await self.ask_student(queue_state, move)
 
     async def send_help( self, channel,
         *, reply_to=None, error=None, short=True,
@@ -731,30 +3165,187 @@ class QueueBot(discord.Client):
         sentences.append(
             f"Формат команд: `@{channel.guild.me.name} <команда>`." )
         sentences.append(QUEUE_COMMANDS_SHORT if short else QUEUE_COMMANDS)
-        await channel.send( " ".join(sentences),
+        await self.send( channel, " ".join(sentences),
             allowed_mentions=discord.AllowedMentions(
                 everyone=False, roles=False,
                 users=[reply_to] if reply_to is not None else False )
         )
 
-async def main():
+class ShardedQueueBot(QueueBot, discord.AutoShardedClient):
+    # all shards of shard_ids (or all shards) in one process
+    pass
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Records are passed to the listener thread with only the message
+    # rendered; formatting (and tracebacks) is left to the thread.
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class JsonLogFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = { "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage() }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def shard_ids_type(value):
+    # "0-3,6" -> [0, 1, 2, 3, 6]
+    shard_ids = list()
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(shard_ids))
+
+def main():
     parser = argparse.ArgumentParser("QueueBot for Discord")
     parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING"], default="INFO")
     parser.add_argument("--log-file")
+    parser.add_argument("--log-format", choices=["text", "json"],
+        default="text" )
+    parser.add_argument("--state-file",
+        help="SQLite file to keep queue states in between restarts" )
+    parser.add_argument("--reconcile-concurrency", type=int,
+        default=RECONCILE_CONCURRENCY,
+        help="number of channels or students reconsidered at once on startup" )
+    parser.add_argument("--record",
+        help="file to record gateway events to, for bench/replay.py" )
+    parser.add_argument("--record-anonymize", action="store_true",
+        help="scramble ids and drop names in the recording, "
+            "with the key from RECORD_KEY environment variable" )
+    parser.add_argument("--metrics-port", type=int,
+        help="serve Prometheus metrics on this port, at /metrics" )
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--diagnostics-file",
+        help="watch the event loop, and write stacks of its stalls here" )
+    parser.add_argument("--lag-threshold", type=float, default=LAG_THRESHOLD,
+        help="seconds of event loop lag that count as a stall" )
+    parser.add_argument("--handler-budget", type=float,
+        default=HANDLER_BUDGET,
+        help="seconds an event handler may take without a warning" )
+    parser.add_argument("--coalesce-window", type=float,
+        default=COALESCE_WINDOW,
+        help="seconds to wait for more events of a student before "
+            "updating their messages (0 to update at once)" )
+    parser.add_argument("--event-workers", type=int, default=EVENT_WORKERS,
+        help="events of one server handled at once" )
+    parser.add_argument("--event-queue-size", type=int,
+        default=EVENT_QUEUE_SIZE,
+        help="events of one server waiting to be handled, "
+            "before the overflow policy applies" )
+    parser.add_argument("--event-overflow", choices=["shed", "wait"],
+        default="shed",
+        help="what to do with student updates when the queue is full: "
+            "shed them until the queue is down to half, or queue them "
+            "anyway up to twice the size; as many other events wait for "
+            "room, and commands always get in" )
+    parser.add_argument("--lean-members", action="store_true",
+        help="cache only members in voice channels, load other students "
+            "when needed, and do not download all members on startup" )
+    parser.add_argument("--no-chunking", action="store_true",
+        help="do not download all members on startup" )
+    parser.add_argument("--shard-count",
+        help="number of gateway shards, or “auto” to ask Discord" )
+    parser.add_argument("--shard-ids", type=shard_ids_type,
+        help="shards of this process, like 0-3 or 0,2 "
+            "(all shards by default)" )
+    parser.add_argument("--processes", type=int, default=1,
+        help="split the shards between this many processes" )
     args = parser.parse_args()
+    record_key = None
+    if args.record_anonymize:
+        record_key = os.getenv('RECORD_KEY')
+        if not record_key:
+            parser.error("--record-anonymize needs RECORD_KEY to be set")
+    if args.shard_count not in {None, "auto"}:
+        try:
+            args.shard_count = int(args.shard_count)
+        except ValueError:
+            parser.error("--shard-count must be a number or “auto”")
+    if args.processes > 1:
+        if args.shard_count == "auto" or args.shard_ids is not None:
+            parser.error( "--processes needs a numeric --shard-count "
+                "and no --shard-ids" )
+        if args.shard_count is None:
+            args.shard_count = args.processes
+        if args.shard_count < args.processes:
+            parser.error("--shard-count is less than --processes")
+        run_processes(args, record_key)
+        return
+    if args.shard_ids is not None:
+        if not isinstance(args.shard_count, int):
+            parser.error("--shard-ids needs a numeric --shard-count")
+        if args.shard_ids[-1] >= args.shard_count:
+            parser.error("--shard-ids must be less than --shard-count")
+    asyncio.run(serve(args, record_key))
+
+def run_processes(args, record_key):
+    # Every process owns a contiguous range of shards, and with it all
+    # the servers of those shards; nothing but the state file is shared.
+    # Files and ports of the processes get their number appended.
+    context = multiprocessing.get_context("spawn")
+    processes = list()
+    for index in range(args.processes):
+        shard_ids = list(range(
+            index * args.shard_count // args.processes,
+            (index + 1) * args.shard_count // args.processes ))
+        process_args = argparse.Namespace(**vars(args))
+        process_args.processes = 1
+        process_args.shard_ids = shard_ids
+        for name in ("log_file", "record", "diagnostics_file"):
+            path = getattr(args, name)
+            if path is not None:
+                setattr(process_args, name, f"{path}.{index}")
+        if args.metrics_port is not None:
+            process_args.metrics_port = args.metrics_port + index
+        process = context.Process( target=run_process,
+            args=(process_args, record_key),
+            name=f"shards-{shard_ids[0]}-{shard_ids[-1]}" )
+        process.start()
+        processes.append(process)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # the processes have got the interrupt as well
+        for process in processes:
+            process.join()
+
+def run_process(args, record_key):
+    try:
+        asyncio.run(serve(args, record_key))
+    except KeyboardInterrupt:
+        pass
+
+async def serve(args, record_key):
     _LOGGER.setLevel(args.log_level)
-    log_formatter = logging.Formatter(
-        "%(asctime)s %(message)s",
-        "%Y-%m-%d %H:%M:%S" )
+    # handlers write from a listener thread, never from the event loop
+    log_handlers = list()
+    log_format = "%(asctime)s %(message)s"
+    if multiprocessing.parent_process() is not None:
+        log_format = "%(asctime)s [%(processName)s] %(message)s"
+    if args.log_format == "json":
+        log_formatter = JsonLogFormatter()
+    else:
+        log_formatter = logging.Formatter(
+            log_format,
+            "%Y-%m-%d %H:%M:%S" )
     if args.log_file is None:
         log_stream_handler = logging.StreamHandler()
-        _LOGGER.addHandler(log_stream_handler)
+        log_handlers.append(log_stream_handler)
         log_stream_handler.setFormatter(log_formatter)
     else:
         log_stream_handler = logging.StreamHandler()
         log_stream_handler.setLevel("ERROR")
         log_stream_handler.setFormatter(log_formatter)
-        _LOGGER.addHandler(log_stream_handler)
+        log_handlers.append(log_stream_handler)
         log_file_handler = logging.handlers.RotatingFileHandler(
             args.log_file,
             maxBytes=(1 << 18), backupCount=1 )
@@ -763,14 +3354,44 @@ async def main():
                 pass
         log_file_handler.rotator = antirotator
         log_file_handler.setFormatter(log_formatter)
-        _LOGGER.addHandler(log_file_handler)
-    _LOGGER.info("starting up")
-    _LOGGER.debug("debug output enabled")
-    client = QueueBot()
-    await client.start(os.getenv('DISCORD_TOKEN'))
-    _LOGGER.info("shutting down")
+        log_handlers.append(log_file_handler)
+    log_queue = queue.SimpleQueue()
+    _LOGGER.addHandler(LogQueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener( log_queue,
+        *log_handlers, respect_handler_level=True )
+    log_listener.start()
+    try:
+        _LOGGER.info("starting up")
+        _LOGGER.debug("debug output enabled")
+        client_class = QueueBot
+        client_kwargs = dict()
+        if args.shard_count is not None:
+            client_class = ShardedQueueBot
+            if args.shard_count != "auto":
+                client_kwargs.update( shard_count=args.shard_count,
+                    shard_ids=args.shard_ids )
+        client = client_class( **client_kwargs,
+            state_file=args.state_file,
+            reconcile_concurrency=args.reconcile_concurrency,
+            coalesce_window=args.coalesce_window,
+            record_file=args.record, record_key=record_key,
+            metrics_address=( (args.metrics_host, args.metrics_port)
+                if args.metrics_port is not None else None ),
+            diagnostics_file=args.diagnostics_file,
+            lag_threshold=args.lag_threshold,
+            handler_budget=args.handler_budget,
+            event_workers=args.event_workers,
+            event_queue_size=args.event_queue_size,
+            event_overflow=args.event_overflow,
+            lean_members=args.lean_members,
+            chunk_members=not args.no_chunking )
+        await client.start(os.getenv('DISCORD_TOKEN'))
+        _LOGGER.info("shutting down")
+    finally:
+        # drains whatever is still queued
+        log_listener.stop()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
 
 # vim: set wrap lbr :